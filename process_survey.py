@@ -2,9 +2,15 @@
 
 VERSION = "0.4.0"
 
-import re, random, sys, itertools, string, csv, os, difflib, subprocess
+import re, random, sys, itertools, string, csv, os, difflib, subprocess, locale, hashlib
+import io, contextlib, concurrent.futures, json, struct, html, warnings, sqlite3, datetime, asyncio
+import tempfile, shutil, time, tracemalloc, cProfile, pstats, gzip, lzma, bz2
 import numpy as np
 import argparse
+try:
+    import resource
+except ImportError:
+    resource = None # not on Windows, so no peak RSS in the metrics
 
 ######################################################################
 ######################################################################
@@ -13,93 +19,818 @@ import argparse
 FILENAME_PREFIX = "example_"
 
 N_a = 5 # maximum number of answers per question
+NO_ANSWER = -1 # answer index used for blank or invalid answers
 LAST_SCANTRON_QUESTION_NUMBER = 96
 
+# layout of each line of the Scantron file: the 0-based character
+# offset and width of each field, the characters allowed in it, and
+# for the Answers field the character for each answer index (0 = A,
+# 1 = B, etc), with the other allowed characters read as blank. The
+# terminator is a line that ends the file (or None). Other scanners
+# are described by a <prefix>layout.json file in the same format (see
+# read_layout()).
+SCANTRON_LAYOUT = {
+    "name": "default",
+    "terminator": "\u001a", # Ctrl-Z
+    "fields": {
+        "Section": {"offset": 60, "width": 3, "alphabet": "0123456789", "min_length": 3, "strip": True},
+        "Answers": {"offset": 72, "width": LAST_SCANTRON_QUESTION_NUMBER, "alphabet": "0123456789 ",
+                    "encoding": "123456789"},
+    },
+}
+
+# compressed Scantron files are recognized by their first bytes, and
+# <prefix>scantron.dat can also be <prefix>scantron.dat.gz and so on
+COMPRESSION_MAGIC = [(b"\x1f\x8b", gzip), (b"\xfd7zXZ\x00", lzma), (b"BZh", bz2)]
+COMPRESSED_EXTENSIONS = [".gz", ".xz", ".bz2"]
+
+# cache of parsed library and Scantron files, shared by all surveys
+CACHE_DIRNAME = ".process_survey_cache"
+CACHE_MAX_BYTES = 1024 * 1024 * 1024 # oldest entries are removed above this size
+
+WATCH_INTERVAL = 2.0 # seconds between checks of the --watch directory
+
+# number of Scantrons with problems that are shown as examples, the
+# rest are only counted
+VALIDATION_EXAMPLES = 10
+
+# --benchmark results are compared to this file, and are regressions if
+# a stage takes this factor more time or memory than the baseline
+BENCHMARK_BASELINE = "benchmark_baseline.json"
+BENCHMARK_TOLERANCE = 1.5
+
 ######################################################################
 ######################################################################
 # Filenames
 
-# input filenames
-LIBRARY_FILENAME = FILENAME_PREFIX + "library.tex"
-SCANTRON_FILENAME = FILENAME_PREFIX + "scantron.dat"
+def survey_filenames(prefix):
+    """f = survey_filenames(prefix)
+
+    All the filenames for the survey with the given filename prefix.
+    """
+    f = Struct()
+
+    # input filenames
+    f.library = prefix + "library.tex"
+    f.layout = prefix + "layout.json"
+    f.scantron = prefix + "scantron.dat"
+    if not os.path.isfile(f.scantron):
+        for extension in COMPRESSED_EXTENSIONS:
+            if os.path.isfile(f.scantron + extension):
+                f.scantron += extension
+                break
 
-# output filenames
-ANSWERS_FILENAME = FILENAME_PREFIX + "answers.csv"
-REPORT_FILENAME = FILENAME_PREFIX + "report.tex"
-RAW_STATS_PREFIX = FILENAME_PREFIX + "stats"
+    # output filenames
+    f.answers = prefix + "answers.csv"
+    f.data_dir = prefix + "data"
+    f.report = prefix + "report.tex"
+    f.figures_dir = prefix + "figures"
+    f.svg_dir = prefix + "svg"
+    f.raw_stats_prefix = prefix + "stats"
+    f.quarantine = prefix + "quarantine.dat"
 
-# logging filenames
-LOG_PROC_REPORT_FILENAME = FILENAME_PREFIX + "proc_report.log"
+    # cache filenames
+    f.scantron_state = prefix + "scantron_state.npz"
+
+    # logging filenames
+    f.log_proc_report = prefix + "proc_report.log"
+    f.metrics = prefix + "metrics.json"
+    f.profile = prefix + "profile"
+
+    return f
 
 # plot style
 PLOT_STYLE = "bar"
 
+# confidence level of the --bootstrap intervals
+BOOTSTRAP_CONFIDENCE = 0.95
+
+# plot backend: "pgfplots" lays out each plot when TeX runs, "tikz"
+# draws plain shapes with the layout already computed here, which
+# compiles much faster
+PLOT_BACKEND = "pgfplots"
+
+# LaTeX command used by --compile
+PDFLATEX = "pdflatex"
+
 ######################################################################
 ######################################################################
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("-q", "--question", help="filter by this question number (1, 2, ...)", type=int)
-    parser.add_argument("-a", "--answer", help="filter to only include this answer to the specified question (A to F)", choices=['A', 'B', 'C', 'D', 'E'])
+    parser.add_argument("-q", "--question", help="filter by this question number (1, 2, ...), can be given more than once", type=int, action="append")
+    parser.add_argument("-a", "--answer", help="filter to only include this answer to the specified question (A to F), one for each --question", choices=['A', 'B', 'C', 'D', 'E'], action="append")
+    parser.add_argument("--all-filters", help="also write a filtered report for every answer to every question", action="store_true")
+    parser.add_argument("--by-section", help="also write statistics for each Section and a report with one chapter per section", action="store_true")
+    parser.add_argument("--correlations", help="also compute the Pearson and Spearman correlations between every pair of questions and show them as a heatmap in the report", action="store_true")
+    parser.add_argument("--drop-duplicates", help="leave out Scantrons that are duplicates of earlier ones (such as a stack scanned twice)", action="store_true")
+    parser.add_argument("--chunk-size", help="stream the Scantron file in chunks of this many Scantrons, so memory use does not depend on the file length", type=int, metavar="N")
+    parser.add_argument("--incremental", help="only read Scantrons appended to the Scantron file since the last --incremental run", action="store_true")
+    parser.add_argument("--layout", help="scanner layout file describing the fields of each Scantron line, for this run and --generate (default: <prefix>layout.json if it exists, otherwise SCANTRON_LAYOUT)", metavar="FILE")
+    parser.add_argument("--no-cache", help="always parse the library and Scantron files instead of using cached results", action="store_true")
+    parser.add_argument("--batch", help="process every <prefix>library.tex and <prefix>scantron.dat pair in this directory tree", metavar="DIR")
+    parser.add_argument("--compile", help="compile the reports to PDF, only recompiling the figures that have changed", action="store_true")
+    parser.add_argument("--bootstrap", help="add confidence intervals from this many bootstrap replicates", type=int, default=0, metavar="N")
+    parser.add_argument("--seed", help="random seed for --bootstrap, --generate and --benchmark (default: 0)", type=int, default=0)
+    parser.add_argument("--svg", help="also write the plot of each question as an SVG file, without running TeX", action="store_true")
+    parser.add_argument("--store", help="add the results to this SQLite database of results from all courses and terms", metavar="DB")
+    parser.add_argument("--course", help="course name for --store and --query (default: the filename prefix up to the term)")
+    parser.add_argument("--term", help="term for --store (default: the last part of the filename prefix, like sp18)")
+    parser.add_argument("--query", help="print the results in --store for every question containing this text, for every course and term, then exit", metavar="TEXT")
+    parser.add_argument("--watch", help="keep watching this directory for new Scantron files and process each survey as they arrive", metavar="DIR")
+    parser.add_argument("-j", "--jobs", help="number of surveys to process in parallel with --batch or --watch, or figures to compile in parallel with --compile (default: number of CPUs)", type=int)
+    parser.add_argument("--log-level", help="only log messages at this level or above (default: info)", choices=sorted(LOG_LEVELS, key=LOG_LEVELS.get), default="info")
+    parser.add_argument("-v", "--verbose", help="log whole arrays instead of summaries", action="store_true")
+    parser.add_argument("--profile", help="profile the run with cProfile, writing <prefix>profile.prof and <prefix>profile.txt, and trace the peak memory of each stage", action="store_true")
+    parser.add_argument("--generate", help="write a synthetic Scantron file with --sheets Scantrons and exit", metavar="FILE")
+    parser.add_argument("--benchmark", help="time each stage on synthetic data with --sheets Scantrons, compare to the baseline and exit", action="store_true")
+    parser.add_argument("--save-baseline", help="save the --benchmark results as the new baseline", action="store_true")
+    parser.add_argument("--sheets", help="number of Scantrons for --generate and --benchmark (default: 100000)", type=int, default=100000)
+    parser.add_argument("--bad-fraction", help="fraction of --generate Scantrons with an invalid character (default: 0)", type=float, default=0.0)
+    parser.add_argument("--short-fraction", help="fraction of --generate Scantrons that are too short (default: 0)", type=float, default=0.0)
     args = parser.parse_args()
-    if (args.question is not None and args.answer is None) \
-       or (args.question is None and args.answer is not None):
+    if args.generate is not None:
+        # there is no log file, so layout errors are only printed
+        with logging_to(io.StringIO()):
+            layout = read_layout(args.layout)
+            generate_scantrons(args.generate, args.sheets, layout.answers.width, args.seed,
+                               args.bad_fraction, args.short_fraction, layout=layout)
+        sys.exit(0)
+    if args.benchmark:
+        if not benchmark(args.sheets, args.seed, BENCHMARK_BASELINE, args.save_baseline):
+            sys.exit(1)
+        sys.exit(0)
+    filters = list(zip(args.question or [], [chr2ind(answer) for answer in args.answer or []]))
+    if len(args.question or []) != len(args.answer or []):
         print("ERROR: must specify --question and --answer together");
         parser.print_help()
         sys.exit(1)
+    if args.incremental and (len(filters) > 0 or args.all_filters):
+        print("ERROR: --incremental cannot be used with --question, --answer, or --all-filters");
+        parser.print_help()
+        sys.exit(1)
+    if args.bootstrap > 0 and (args.chunk_size is not None or args.incremental):
+        print("ERROR: --bootstrap cannot be used with --chunk-size or --incremental");
+        parser.print_help()
+        sys.exit(1)
+    if args.drop_duplicates and (args.chunk_size is not None or args.incremental):
+        print("ERROR: --drop-duplicates cannot be used with --chunk-size or --incremental");
+        parser.print_help()
+        sys.exit(1)
+    if args.query is not None:
+        if args.store is None:
+            print("ERROR: --query needs --store");
+            parser.print_help()
+            sys.exit(1)
+        query_store(args.store, args.query, args.course)
+        sys.exit(0)
+
+    options = survey_options(filters=filters,
+                             all_filters=args.all_filters,
+                             drop_duplicates=args.drop_duplicates,
+                             by_section=args.by_section,
+                             correlations=args.correlations,
+                             chunk_size=args.chunk_size,
+                             incremental=args.incremental,
+                             layout=args.layout,
+                             cache_dir=None if args.no_cache else CACHE_DIRNAME,
+                             log_level=LOG_LEVELS[args.log_level],
+                             verbose=args.verbose,
+                             compile=args.compile,
+                             svg=args.svg,
+                             bootstrap=args.bootstrap,
+                             bootstrap_seed=args.seed,
+                             store=args.store,
+                             course=args.course,
+                             term=args.term,
+                             profile=args.profile,
+                             compile_jobs=1 if args.batch is not None or args.watch is not None else args.jobs)
+    if args.watch is not None:
+        try:
+            asyncio.run(watch_directory(args.watch, options, args.jobs))
+        except KeyboardInterrupt:
+            print("Stopped watching: %s" % args.watch)
+    elif args.batch is not None:
+        if not process_batch(args.batch, options, args.jobs):
+            sys.exit(1)
+    else:
+        process_survey(FILENAME_PREFIX, options)
+
+def survey_options(**kwargs):
+    """options = survey_options(**kwargs)
+
+    Options for process_survey(), with defaults for any that are not
+    given:
+
+    filters = list of (question number, answer index) to filter by
+    all_filters = whether to write filtered output for every answer
+    by_section = whether to write statistics for each Section
+    correlations = whether to compute the correlations between questions
+    drop_duplicates = whether to leave out duplicate Scantrons
+    chunk_size = number of Scantrons to stream at a time, or None to
+                 read the whole Scantron file into memory
+    incremental = whether to only read Scantrons appended since the
+                  last incremental run
+    layout = scanner layout file, or None for <prefix>layout.json if
+             it exists and SCANTRON_LAYOUT otherwise
+    cache_dir = directory for cached parse results, or None for no cache
+    log_level = only log messages at this level or above
+    verbose = whether to log whole arrays instead of summaries
+    compile = whether to compile the reports to PDF
+    compile_jobs = number of figures to compile in parallel, or None
+                   for the number of CPUs
+    svg = whether to also write each plot as an SVG file
+    bootstrap = number of bootstrap replicates for confidence
+                intervals, or 0 for none
+    bootstrap_seed = seed for the bootstrap resampling
+    store = SQLite database to add the results to, or None
+    course, term = names of the results in the store, or None to get
+                   them from the prefix with split_prefix()
+    profile = whether to profile the run with cProfile and tracemalloc
+    """
+    options = Struct()
+    options.filters = []
+    options.all_filters = False
+    options.drop_duplicates = False
+    options.by_section = False
+    options.correlations = False
+    options.chunk_size = None
+    options.incremental = False
+    options.layout = None
+    options.cache_dir = None
+    options.log_level = LOG_INFO
+    options.verbose = False
+    options.compile = False
+    options.compile_jobs = None
+    options.svg = False
+    options.bootstrap = 0
+    options.bootstrap_seed = 0
+    options.store = None
+    options.course = None
+    options.term = None
+    options.profile = False
+    for (name, value) in kwargs.items():
+        if not hasattr(options, name):
+            raise Exception("unknown survey option: %s" % name)
+        setattr(options, name, value)
+    return options
+
+def process_survey(prefix, options=None):
+    """process_survey(prefix, options=None)
+
+    Run the whole pipeline for the survey with the given filename
+    prefix, logging to its own log file. The options are from
+    survey_options().
+    """
+    if options is None:
+        options = survey_options()
+    filters = options.filters
+    f = survey_filenames(prefix)
+    init_logging(f.log_proc_report, options.log_level, options.verbose)
+    init_metrics()
+    try:
+        profiler = None
+        if options.profile:
+            tracemalloc.start()
+            profiler = cProfile.Profile()
+            profiler.enable()
+        log_and_print("process_questions version %s", VERSION)
+        library = run_stage("read_library", read_library_cached, f.library, options.cache_dir)
+        N_q = sum([len(zone.questions) for zone in library.zones])
+        layout_filename = options.layout
+        if layout_filename is None and os.path.isfile(f.layout):
+            layout_filename = f.layout
+        layout = read_layout(layout_filename)
+        if options.incremental:
+            (n_s_qa, N_s) = run_stage("ingest_scantrons", ingest_scantrons, f.scantron_state, f.scantron, f.answers,
+                                      f.data_dir, f.quarantine, library, N_q, N_a, options.chunk_size, layout)
+            d = run_stage("generate_statistics", generate_statistics_from_counts, f.raw_stats_prefix, n_s_qa, N_s)
+        elif options.chunk_size is not None:
+            (n_s_qa, N_s, n_s_qaqa) = run_stage("stream_scantrons", stream_scantrons, f.scantron, f.answers,
+                                                f.data_dir, f.quarantine, library, N_q, N_a, filters,
+                                                options.chunk_size, options.all_filters, layout)
+            d = run_stage("generate_statistics", generate_statistics_from_counts, f.raw_stats_prefix, n_s_qa, N_s)
+        else:
+            # hashed once for both the parse cache and the co-occurrence cache
+            scantron_hash = None
+            if options.cache_dir is not None:
+                scantron_hash = run_stage("hash_scantrons", file_hash, f.scantron)
+            (a, section, line, key) = run_stage("read_scantrons", read_scantrons_cached, f.scantron, N_q,
+                                                options.cache_dir, f.quarantine, layout, scantron_hash)
+            (a, section) = run_stage("dedup_scantrons", dedup_scantrons, a, section, line, key,
+                                     options.drop_duplicates)
+            if len(filters) == 1 or options.all_filters:
+                n_s_qaqa = run_stage("read_cooccurrence", read_cooccurrence, options.cache_dir, f.scantron, a, N_a,
+                                     layout.hash + (" dedup" if options.drop_duplicates else ""), scantron_hash)
+            if len(filters) > 0:
+                (a, section) = run_stage("filter_scantrons", filter_scantrons, a, section, filters)
+            run_stage("write_answers", write_answers, f.answers, library, a, N_a)
+            if len(filters) == 1:
+                d = run_stage("generate_statistics", generate_filtered_statistics, f.raw_stats_prefix, n_s_qaqa,
+                              filters[0][0], filters[0][1])
+                d.a = a
+                if options.bootstrap > 0:
+                    run_stage("generate_bootstrap_intervals", generate_bootstrap_intervals, f.raw_stats_prefix, d, a,
+                              options.bootstrap, options.bootstrap_seed)
+                if options.correlations:
+                    run_stage("generate_correlations", generate_correlations, f.raw_stats_prefix, d, a)
+            else:
+                d = run_stage("generate_statistics", generate_statistics, f.raw_stats_prefix, a, N_a,
+                              options.bootstrap, options.bootstrap_seed, options.correlations)
+            d.section = section
+            run_stage("write_binary_answers", write_binary_answers, f.data_dir, a, section)
+        if options.correlations and (options.incremental or options.chunk_size is not None):
+            (a, section) = run_stage("read_binary_answers", read_binary_answers, f.data_dir)
+            run_stage("generate_correlations", generate_correlations, f.raw_stats_prefix, d, a)
+        run_stage("write_binary_statistics", write_binary_statistics, f.data_dir, library, d)
+        if options.store is not None:
+            (course, term) = split_prefix(prefix)
+            run_stage("store_results", store_results, options.store, options.course or course, options.term or term,
+                      "_".join("q%d%s" % (q, ind2chr(a)) for (q, a) in filters), library, d)
+        figures_dir = f.figures_dir if options.compile else None
+        reports = [(f.report, run_stage("write_statistics", write_statistics, f.report, library, d, figures_dir))]
+        if options.all_filters:
+            reports += run_stage("write_all_filtered_statistics", write_all_filtered_statistics, prefix, library,
+                                 n_s_qaqa, figures_dir)
+        if options.by_section:
+            if options.incremental or options.chunk_size is not None:
+                (a, section) = run_stage("read_binary_answers", read_binary_answers, f.data_dir)
+            reports += run_stage("write_section_statistics", write_section_statistics, prefix, library, a, section,
+                                 figures_dir)
+        if options.svg:
+            run_stage("write_svg_figures", write_svg_figures, f.svg_dir, library, d)
+        if options.compile:
+            run_stage("compile_reports", compile_reports, reports, f.figures_dir, options.compile_jobs)
+        if profiler is not None:
+            profiler.disable()
+            write_profile(f.profile, profiler)
+        write_metrics(f.metrics, prefix)
+        if profiler is not None:
+            tracemalloc.stop()
+        close_logging()
+    finally:
+        # so that nothing after the run (like a SurveyProcessor) adds to its metrics
+        close_metrics()
 
-    init_logging(LOG_PROC_REPORT_FILENAME)
-    log_and_print("process_questions version %s" % VERSION)
-    library = read_library(LIBRARY_FILENAME)
-    N_q = sum([len(zone.questions) for zone in library.zones])
-    a = read_scantrons(SCANTRON_FILENAME, N_q)
-    if args.question is not None:
-        a = filter_scantrons(a, args.question, args.answer)
-    write_answers(ANSWERS_FILENAME, library, a, N_a)
-    d = generate_statistics(RAW_STATS_PREFIX, a, N_a)
-    write_statistics(REPORT_FILENAME, library, d)
+######################################################################
+######################################################################
+
+def find_surveys(directory):
+    """prefixes = find_surveys(directory)
+
+    Find every <prefix>library.tex file in the directory tree that has
+    a matching <prefix>scantron.dat file.
+    """
+    prefixes = []
+    for (dirpath, dirnames, filenames) in os.walk(directory):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith("library.tex"):
+                prefix = os.path.join(dirpath, filename[:-len("library.tex")])
+                if os.path.isfile(survey_filenames(prefix).scantron):
+                    prefixes.append(prefix)
+    return prefixes
+
+def process_survey_job(prefix, options):
+    """(prefix, ok, output) = process_survey_job(prefix, options)
+
+    Run process_survey() in a batch worker process, capturing the
+    console output instead of printing it.
+    """
+    output = io.StringIO()
+    ok = False
+    with contextlib.redirect_stdout(output):
+        try:
+            process_survey(prefix, options)
+            ok = True
+        except SystemExit:
+            pass
+        except Exception as e:
+            print("ERROR: %s" % e)
+    close_logging()
+    return (prefix, ok, output.getvalue())
+
+def process_batch(directory, options=None, jobs=None):
+    """ok = process_batch(directory, options=None, jobs=None)
+
+    Process every survey found by find_surveys() with the given
+    survey_options() in a pool of 'jobs' worker processes. Each survey is logged to its own log file.
+    Returns True if all surveys were processed successfully.
+    """
+    prefixes = find_surveys(directory)
+    print("Found %d surveys in: %s" % (len(prefixes), directory))
+    n_failed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(process_survey_job, prefix, options)
+                   for prefix in prefixes]
+        for future in concurrent.futures.as_completed(futures):
+            (prefix, ok, output) = future.result()
+            if ok:
+                print("Completed survey: %s" % prefix)
+            else:
+                n_failed += 1
+                print(output, end="")
+                print("ERROR: failed to process survey: %s (see %s)"
+                      % (prefix, survey_filenames(prefix).log_proc_report))
+    print("Processed %d surveys, %d failed" % (len(prefixes), n_failed))
+    return n_failed == 0
+
+def match_scan(directory, filename):
+    """prefix = match_scan(directory, filename)
+
+    The prefix of the survey that a Scantron file dropped in the
+    directory belongs to, which is the longest prefix of the filename
+    with a <prefix>library.tex file in the directory, or None if there
+    isn't one. For example "tam212_sp18_scan2.dat" belongs to the
+    survey "tam212_sp18_".
+    """
+    prefixes = [name[:-len("library.tex")] for name in os.listdir(directory)
+                if name.endswith("library.tex")]
+    prefixes = [prefix for prefix in prefixes if filename.startswith(prefix)]
+    if len(prefixes) == 0:
+        return None
+    return os.path.join(directory, max(prefixes, key=len))
+
+def append_scan(filename, scantron_filename):
+    """ok = append_scan(filename, scantron_filename)
+
+    Append the Scantron file dropped in the watched directory to the
+    existing Scantron file of its survey, as a new batch, and remove
+    the dropped file. A last line with a single character (like the
+    Ctrl-Z line) is removed from the end of the existing file first,
+    and a last line without a newline is ended. Compressed files can't
+    be appended to, so False is returned and nothing is changed if
+    either file is compressed.
+    """
+    for name in [filename, scantron_filename]:
+        with open(name, "rb") as in_f:
+            if compression_module(in_f) is not None:
+                print("WARNING: can't add %s to %s, as %s is compressed" % (filename, scantron_filename, name))
+                return False
+    size = os.path.getsize(scantron_filename)
+    end = last_line_end(scantron_filename, 0, size)
+    with open(scantron_filename, "r+b") as out_f, open(filename, "rb") as in_f:
+        if size - end == 1:
+            out_f.truncate(end)
+        elif size > end:
+            out_f.seek(size)
+            out_f.write(b"\n")
+        out_f.seek(0, os.SEEK_END)
+        shutil.copyfileobj(in_f, out_f, 1 << 20)
+    os.remove(filename)
+    return True
+
+async def watch_directory(directory, options=None, jobs=None, interval=WATCH_INTERVAL):
+    """await watch_directory(directory, options=None, jobs=None, interval=WATCH_INTERVAL)
+
+    Watch the directory for new or changed .dat files, checking every
+    'interval' seconds, and process the survey that each one belongs
+    to (see match_scan()) as soon as the file stops changing. Dropped
+    files are first renamed to <prefix>scantron.dat, or appended to it
+    with append_scan() if it already exists, so that every batch is
+    kept (with options.incremental only the new batch is read).
+    Surveys are processed with the given survey_options() in a pool
+    of 'jobs' worker processes, which keep the parsed libraries in
+    memory between runs. A survey that changes while it is being processed
+    is processed again afterwards. If a worker process dies then that
+    survey fails and a new pool is started. This never returns.
+    """
+    loop = asyncio.get_running_loop()
+    done = {}    # filename -> (size, mtime) when last processed
+    polled = {}  # filename -> (size, mtime) at the last check
+    running = set()
+    pending = set()
+    tasks = set()
+    # Scantron files older than their report were processed before
+    for name in os.listdir(directory):
+        if name.endswith("scantron.dat"):
+            f = survey_filenames(os.path.join(directory, name[:-len("scantron.dat")]))
+            if os.path.isfile(f.report) and os.path.getmtime(f.report) >= os.path.getmtime(f.scantron):
+                stat = os.stat(f.scantron)
+                done[f.scantron] = (stat.st_size, stat.st_mtime)
+
+    async def run(prefix):
+        nonlocal executor
+        running.add(prefix)
+        try:
+            while True:
+                print("Processing survey: %s" % prefix)
+                pool = executor
+                try:
+                    (prefix, ok, output) = await loop.run_in_executor(pool, process_survey_job, prefix, options)
+                except Exception as e:
+                    (ok, output) = (False, "ERROR: %s\n" % e)
+                    if isinstance(e, concurrent.futures.process.BrokenProcessPool) and pool is executor:
+                        # a worker died, so start a new pool for the later surveys
+                        executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+                        pool.shutdown(wait=False)
+                if ok:
+                    print("Completed survey: %s" % prefix)
+                else:
+                    print(output, end="")
+                    print("ERROR: failed to process survey: %s (see %s)"
+                          % (prefix, survey_filenames(prefix).log_proc_report))
+                if prefix not in pending:
+                    break
+                pending.discard(prefix)
+        finally:
+            running.discard(prefix)
+
+    def start(prefix):
+        if prefix in running:
+            pending.add(prefix)
+            return
+        task = asyncio.ensure_future(run(prefix))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    print("Watching for Scantron files in: %s" % directory)
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+    try:
+        while True:
+            current = {}
+            for name in sorted(os.listdir(directory)):
+                filename = os.path.join(directory, name)
+                if name.endswith(".dat") and not name.endswith("quarantine.dat") and os.path.isfile(filename):
+                    stat = os.stat(filename)
+                    current[filename] = (stat.st_size, stat.st_mtime)
+            for filename in current:
+                # only use files that didn't change since the last check
+                # (checked again as earlier files may have been renamed)
+                stat = os.stat(filename) if os.path.isfile(filename) else None
+                stat = stat and (stat.st_size, stat.st_mtime)
+                if stat is None or done.get(filename) == stat or polled.get(filename) != stat:
+                    continue
+                done[filename] = stat
+                prefix = match_scan(directory, os.path.basename(filename))
+                if prefix is None:
+                    print("WARNING: no library file for Scantron file: %s" % filename)
+                    continue
+                scantron_filename = survey_filenames(prefix).scantron
+                if filename != scantron_filename:
+                    if os.path.isfile(scantron_filename):
+                        print("Adding %s to %s" % (filename, scantron_filename))
+                        if not append_scan(filename, scantron_filename):
+                            continue
+                    else:
+                        print("Renaming %s to %s" % (filename, scantron_filename))
+                        os.replace(filename, scantron_filename)
+                    stat = os.stat(scantron_filename)
+                    done[scantron_filename] = (stat.st_size, stat.st_mtime)
+                start(prefix)
+            polled = current
+            await asyncio.sleep(interval)
+    finally:
+        # the pool may have been replaced by run()
+        executor.shutdown()
 
 ######################################################################
 ######################################################################
 
+LOG_DEBUG = 10
+LOG_INFO = 20
+LOG_WARNING = 30
+LOG_ERROR = 40
+LOG_LEVELS = {"debug": LOG_DEBUG, "info": LOG_INFO, "warning": LOG_WARNING, "error": LOG_ERROR}
+
 log_file = None
+log_level = LOG_INFO
+log_verbose = False
 
-def init_logging(output_filename):
-    global log_file
+def init_logging(output_filename, level=LOG_INFO, verbose=False):
+    """init_logging(output_filename, level=LOG_INFO, verbose=False)
+
+    Start logging messages at the given level or above to the output
+    file, which is written in large buffered blocks. If verbose is
+    True then log_array() logs whole arrays.
+    """
+    global log_file, log_level, log_verbose
     try:
         print("Logging information to file: %s" % output_filename)
         if log_file != None:
             raise Exception("logging already initialized")
-        log_file = open(output_filename, "w")
+        log_file = open(output_filename, "w", buffering=1024 * 1024)
+        log_level = level
+        log_verbose = verbose
     except Exception as e:
         print("ERROR: failed to initialize logging: %s" % e)
         sys.exit(1)
 
-def log(msg):
+def close_logging():
     global log_file
+    if log_file != None:
+        log_file.close()
+        log_file = None
+
+@contextlib.contextmanager
+def logging_to(out_f, level=LOG_INFO, verbose=False):
+    """with logging_to(out_f, level=LOG_INFO, verbose=False):
+
+    Log to the open text stream out_f inside the with block, and then
+    restore the previous logging settings.
+    """
+    global log_file, log_level, log_verbose
+    saved = (log_file, log_level, log_verbose)
+    (log_file, log_level, log_verbose) = (out_f, level, verbose)
     try:
-        if log_file == None:
-            raise Exception("logging not initialized")
-        log_file.write(msg + "\n")
-    except Exception as e:
-        print("ERROR: logging failed for message '%s': %s" % (msg, e))
-        sys.exit(1)
+        yield
+    finally:
+        (log_file, log_level, log_verbose) = saved
+
+def log_enabled(level):
+    """Whether messages at the given level are being logged, to skip
+    building expensive messages that would not be logged.
+    """
+    return level >= log_level
+
+def log(msg, *args, level=LOG_INFO):
+    """log(msg, *args, level=LOG_INFO)
 
-def log_and_print(msg):
-    log(msg)
+    Log msg % args, if the level is high enough. The message is only
+    formatted if it will be logged.
+    """
+    if level == LOG_WARNING:
+        count_metric("warnings")
+    if level < log_level:
+        return
+    if log_file == None:
+        print("ERROR: logging not initialized for message: %s" % msg)
+        sys.exit(1)
+    if len(args) > 0:
+        msg = msg % args
+    log_file.write(msg + "\n")
+
+def log_debug(msg, *args):
+    if LOG_DEBUG >= log_level:
+        log(msg, *args, level=LOG_DEBUG)
+
+def log_and_print(msg, *args, level=LOG_INFO):
+    if level < log_level:
+        if level == LOG_WARNING:
+            count_metric("warnings")
+        return
+    if len(args) > 0:
+        msg = msg % args
+    log(msg, level=level)
     print(msg)
 
-def die(msg):
-    log_and_print(msg)
+def die(msg, *args):
+    log_and_print(msg, *args, level=LOG_ERROR)
+    if log_file != None:
+        log_file.flush()
     sys.exit(1)
 
 def log_array(arr, arr_name, dim_names):
+    """log_array(arr, arr_name, dim_names)
+
+    Log the shape of the array and either a summary of it (the counts
+    of each value and the first and last rows) or, in verbose mode,
+    the whole array.
+    """
     if len(arr.shape) != len(dim_names):
         die("log_array length mismatch for %s" % arr_name)
+    if not log_enabled(LOG_INFO):
+        return
     log("%s array: (%s)"
         % (arr_name, ", ".join(["%s = %d" % (dim_names[i], arr.shape[i])
                                 for i in range(len(arr.shape))])))
-    log(np.array_str(arr))
+    if log_verbose:
+        with np.printoptions(threshold=sys.maxsize):
+            log(np.array_str(arr))
+        return
+    if arr.size == 0:
+        return
+    if arr.dtype.kind in "iu" and arr.dtype.itemsize <= 2:
+        # small integers are counted with bincount, which unlike
+        # np.unique doesn't sort, a block at a time to bound the memory
+        (lo, flat) = (int(arr.min()), arr.ravel())
+        counts = np.zeros(int(arr.max()) - lo + 1, dtype=np.int64)
+        block_size = 1 << 20
+        for i in range(0, flat.size, block_size):
+            counts += np.bincount(flat[i:i + block_size].astype(np.intp) - lo, minlength=len(counts))
+        values = np.flatnonzero(counts)
+        (values, counts) = (values + lo, counts[values])
+    else:
+        (values, counts) = np.unique(arr, return_counts=True)
+    if len(values) <= 20:
+        log("%s value counts: %s"
+            % (arr_name, ", ".join(["%s: %d" % (v, c) for (v, c) in zip(values, counts)])))
+    else:
+        log("%s values: min %s, max %s" % (arr_name, arr.min(), arr.max()))
+    n_rows = 3
+    log("%s first rows:\n%s" % (arr_name, np.array_str(arr[:n_rows])))
+    if arr.shape[0] > n_rows:
+        log("%s last rows:\n%s" % (arr_name, np.array_str(arr[-n_rows:])))
+
+######################################################################
+######################################################################
+
+metrics = None # metrics of the survey being processed, see init_metrics()
+
+def init_metrics():
+    """init_metrics()
+
+    Start collecting metrics for a new survey, with run_stage() and
+    count_metric().
+    """
+    global metrics
+    metrics = Struct(started=datetime.datetime.now().isoformat(timespec="seconds"),
+                     wall=time.perf_counter(), cpu=time.process_time(),
+                     stages=[], counters={}, stage=None)
+
+def close_metrics():
+    """close_metrics()
+
+    Stop collecting metrics at the end of a survey, so that
+    count_metric() and run_stage() do nothing until init_metrics() is
+    called again.
+    """
+    global metrics
+    metrics = None
+
+def count_metric(name, n=1):
+    """count_metric(name, n=1)
+
+    Add n to the named counter, both for the whole run and for the
+    stage being run, if metrics are being collected.
+    """
+    if metrics is None:
+        return
+    metrics.counters[name] = metrics.counters.get(name, 0) + int(n)
+    if metrics.stage is not None:
+        metrics.stage["counters"][name] = metrics.stage["counters"].get(name, 0) + int(n)
+
+def count_bytes_written(*filenames):
+    """count_bytes_written(*filenames)
+
+    Add the sizes of the files to the "bytes_written" counter.
+    """
+    count_metric("bytes_written", sum(os.path.getsize(filename) for filename in filenames))
+
+def max_rss_bytes():
+    """Peak resident memory of this process so far, or None if unknown."""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024 # kB on Linux
+
+def run_stage(name, func, *args):
+    """value = run_stage(name, func, *args)
+
+    Return func(*args), recording its wall time, CPU time, peak memory
+    and counters as a stage in the metrics. The tracemalloc peak is
+    only recorded if tracemalloc is running (with --profile).
+    """
+    if metrics is None:
+        return func(*args)
+    stage = {"name": name, "counters": {}}
+    metrics.stage = stage
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    (wall, cpu) = (time.perf_counter(), time.process_time())
+    try:
+        return func(*args)
+    finally:
+        stage["wall_seconds"] = time.perf_counter() - wall
+        stage["cpu_seconds"] = time.process_time() - cpu
+        stage["max_rss_bytes"] = max_rss_bytes()
+        if tracemalloc.is_tracing():
+            stage["tracemalloc_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        metrics.stages.append(stage)
+        metrics.stage = None
+        log("Stage %s took %.3f s wall, %.3f s CPU", name, stage["wall_seconds"], stage["cpu_seconds"])
+
+def write_metrics(output_filename, prefix):
+    """write_metrics(output_filename, prefix)
+
+    Write the metrics of the run to a JSON file.
+    """
+    log_and_print("Writing metrics file: %s" % output_filename)
+    with open(output_filename, "w") as out_f:
+        json.dump({
+            "version": VERSION,
+            "prefix": prefix,
+            "started": metrics.started,
+            "wall_seconds": time.perf_counter() - metrics.wall,
+            "cpu_seconds": time.process_time() - metrics.cpu,
+            "max_rss_bytes": max_rss_bytes(),
+            "counters": metrics.counters,
+            "stages": metrics.stages,
+        }, out_f, indent=2)
+        out_f.write("\n")
+
+def write_profile(output_prefix, profiler):
+    """write_profile(output_prefix, profiler)
+
+    Write the cProfile results to <output_prefix>.prof (for pstats and
+    other viewers) and the top functions by cumulative time to
+    <output_prefix>.txt.
+    """
+    log_and_print("Writing profile: %s.prof" % output_prefix)
+    profiler.dump_stats(output_prefix + ".prof")
+    with open(output_prefix + ".txt", "w") as out_f:
+        stats = pstats.Stats(profiler, stream=out_f)
+        stats.sort_stats("cumulative").print_stats(50)
 
 ######################################################################
 ######################################################################
@@ -107,8 +838,8 @@ def log_array(arr, arr_name, dim_names):
 class Struct(object):
     """Generic structure object.
     """
-    def __init__(self):
-        pass
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
 
 ######################################################################
 ######################################################################
@@ -140,7 +871,7 @@ class LibraryRegexp:
     """
     def __init__(self, name, regexp, no_tail=False):
         self.name = name
-        self.regexp = regexp
+        self.regexp = re.compile(regexp)
         self.no_tail = no_tail
 
 class ReadState:
@@ -198,6 +929,58 @@ def read_library(input_filename):
         input_file = open(input_filename, "r")
     except Exception as e:
         die("ERROR: Unable to open library file for reading: %s: %s" % (input_filename, e))
+    with input_file:
+        library = parse_library(input_filename, input_file)
+    log_library(library)
+    log("Successfully completed library reading")
+    return library
+
+def log_library(library):
+    """log_library(library)
+
+    Log the number of questions in the library and in each zone.
+    """
+    log("Library has %d zones and %d questions", len(library.zones),
+        sum([len(zone.questions) for zone in library.zones]))
+    for zone in library.zones:
+        log("Zone '%s' has %d questions", zone.title, len(zone.questions))
+
+def library_to_json(library):
+    """data = library_to_json(library)
+
+    The library tree as plain dicts, lists and strings, for json.dump().
+    """
+    return {"title_block": library.title_block,
+            "zones": [{"title": zone.title,
+                       "questions": [{"body": question.body, "left_choice": question.left_choice,
+                                      "right_choice": question.right_choice} for question in zone.questions]}
+                      for zone in library.zones]}
+
+def library_from_json(data):
+    """library = library_from_json(data)
+
+    The library tree from the data of library_to_json().
+    """
+    library = Library()
+    library.title_block = data["title_block"]
+    for zone_data in data["zones"]:
+        zone = Zone()
+        zone.title = zone_data["title"]
+        for question_data in zone_data["questions"]:
+            question = Question()
+            question.body = question_data["body"]
+            question.left_choice = question_data["left_choice"]
+            question.right_choice = question_data["right_choice"]
+            zone.questions.append(question)
+        library.zones.append(zone)
+    return library
+
+def parse_library(input_filename, input_file):
+    """library = parse_library(input_filename, input_file)
+
+    Parse the lines of a library file from input_file (any iterable of
+    lines), using input_filename in messages.
+    """
     library_regexps = [
         LibraryRegexp(name="begin_document", regexp=r"^\s*\\begin\{document\}(?P<tail>.*)$", no_tail=True),
         LibraryRegexp(name="begin_zone", regexp=r"^\s*\\begin\{zone\}\{(?P<title>[^}]+)\}(?P<tail>.*)$", no_tail=True),
@@ -209,22 +992,49 @@ def read_library(input_filename):
         ]
     library = Library()
     state = ReadState()
+    i_line = 0
+    line = ""
+    match_name = None
+    match = None
+    def file_log(msg, *args):
+        log_debug("%s:%d: " + msg, input_filename, i_line + 1, *args)
+    def file_die(msg):
+        die("%s:%d: ERROR: %s" % (input_filename, i_line + 1, msg))
+    def transition(new_state_name):
+        file_log(r"state transition: '%s' -> '%s'", state.name, new_state_name)
+        state.name = new_state_name
+    def bad_transition():
+        file_die("'%s' not allowed in state '%s'" % (match_name, state.name))
+    def new_zone():
+        file_log("starting new zone")
+        state.zone = Zone()
+        library.zones.append(state.zone)
+        state.zone.title = match.group("title").strip()
+    def new_question():
+        file_log("starting new question")
+        state.question = Question()
+        state.zone.questions.append(state.question)
+        state.question.body = match.group("body").strip()
+        state.question.left_choice = match.group("left_choice").strip()
+        state.question.right_choice = match.group("right_choice").strip()
+    def append_to_title_block():
+        file_log("appending line to title block")
+        if len(library.title_block) > 0:
+            library.title_block += "\n"
+        library.title_block += line
+
     for (i_line, line) in enumerate(input_file):
-        def file_log(msg):
-            log("%s:%d: %s" % (input_filename, i_line + 1, msg))
-        def file_die(msg):
-            die("%s:%d: ERROR: %s" % (input_filename, i_line + 1, msg))
         line = line.strip()
-        file_log("read line: \"%s\"" % line)
-            
+        file_log("read line: \"%s\"", line)
+
         match_comment = re.search(r"(?<!\\)%", line)
         if match_comment:
             line = line[:match_comment.start()]
-            file_log("stripped comments: \"%s\"" % line)
+            file_log("stripped comments: \"%s\"", line)
         match_name = None
         match = None
         for library_regexp in library_regexps:
-            match = re.match(library_regexp.regexp, line)
+            match = library_regexp.regexp.match(line)
             if match:
                 match_name = library_regexp.name
                 if library_regexp.no_tail:
@@ -234,30 +1044,7 @@ def read_library(input_filename):
                 break
         else:
             file_die("no matches found for line")
-        file_log("found match '%s'" % match_name)
-
-        def transition(new_state_name):
-            file_log(r"state transition: '%s' -> '%s'" % (state.name, new_state_name))
-            state.name = new_state_name
-        def bad_transition():
-            file_die("'%s' not allowed in state '%s'" % (match_name, state.name))
-        def new_zone():
-            file_log("starting new zone")
-            state.zone = Zone()
-            library.zones.append(state.zone)
-            state.zone.title = match.group("title").strip()
-        def new_question():
-            file_log("starting new question")
-            state.question = Question()
-            state.zone.questions.append(state.question)
-            state.question.body = match.group("body").strip()
-            state.question.left_choice = match.group("left_choice").strip()
-            state.question.right_choice = match.group("right_choice").strip()
-        def append_to_title_block():
-            file_log("appending line to title block")
-            if len(library.title_block) > 0:
-                library.title_block += "\n"
-            library.title_block += line
+        file_log("found match '%s'", match_name)
 
         if state.name == "preamble":
             if match_name == "begin_document":   transition("title_block")
@@ -284,98 +1071,1123 @@ def read_library(input_filename):
         else:
             file_die("unknown state '%s'" % state.name)
 
-    input_file.close()
-    log("Successfully completed library reading")
     return library
 
 ######################################################################
 ######################################################################
 
-def read_scantrons(input_filename, N_q):
-    """a = read_scantrons(input_filename, N_q)
+program_source_hash = None # see source_hash()
 
-    Read the scantron data arrays from scantron.dat.
+def source_hash():
+    """h = source_hash()
 
-    a[s,q] = answer given by student s to question q
+    The SHA-1 hex digest of this program's source file (or VERSION if
+    it can't be read), so that cache entries written by any other
+    version of the code are not used.
     """
-    log_and_print("Reading Scantron file: %s" % input_filename)
-    a_data = []
+    global program_source_hash
+    if program_source_hash is None:
+        try:
+            program_source_hash = file_hash(__file__)
+        except OSError:
+            program_source_hash = VERSION
+    return program_source_hash
+
+def cache_filename(cache_dir, kind, *contents):
+    """filename = cache_filename(cache_dir, kind, *contents)
+
+    The filename in the cache directory for an entry of the given kind
+    (which is also the file extension), named by the SHA-1 of the
+    program source and the given contents (each str or bytes).
+    """
+    h = hashlib.sha1(source_hash().encode())
+    for content in contents:
+        if isinstance(content, str):
+            content = content.encode()
+        h.update(b"\0" + content)
+    return os.path.join(cache_dir, "%s.%s" % (h.hexdigest(), kind))
+
+def read_cache(filename, read_func):
+    """data = read_cache(filename, read_func)
+
+    Read a cache entry with read_func(file), or return None if there
+    is no such entry or it can't be read. Reading an entry marks it as
+    recently used.
+    """
+    try:
+        with open(filename, "rb") as in_f:
+            data = read_func(in_f)
+        os.utime(filename)
+        return data
+    except Exception:
+        return None
+
+def write_cache(filename, write_func, max_bytes=CACHE_MAX_BYTES):
+    """write_cache(filename, write_func, max_bytes=CACHE_MAX_BYTES)
+
+    Write a cache entry with write_func(file) and then remove the
+    least recently used entries until the cache is no bigger than
+    max_bytes. Failures are logged but are not errors.
+    """
+    cache_dir = os.path.dirname(filename)
+    tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(tmp_filename, "wb") as out_f:
+            write_func(out_f)
+        os.replace(tmp_filename, filename)
+    except Exception as e:
+        log("WARNING: unable to write cache file %s: %s", filename, e, level=LOG_WARNING)
+        return
+    entries = []
+    for name in os.listdir(cache_dir):
+        try:
+            stat = os.stat(os.path.join(cache_dir, name))
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+    total_bytes = sum([size for (mtime, size, name) in entries])
+    for (mtime, size, name) in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+            log("Removed old cache file: %s" % name)
+        except OSError:
+            pass
+        total_bytes -= size
+
+# parsed Library trees kept in memory by cache filename, so a
+# long-running process (like --watch) doesn't read them again
+loaded_libraries = {}
+
+def read_library_cached(input_filename, cache_dir):
+    """library = read_library_cached(input_filename, cache_dir)
+
+    As for read_library(), but using the cached Library tree if the
+    same library file contents have been read before, either by this
+    process or in the cache directory. The cache directory holds the
+    tree as JSON data (see library_to_json()), so an entry is never
+    run as code. If cache_dir is None then the file is always read.
+    """
+    if cache_dir is None:
+        return read_library(input_filename)
+    try:
+        with open(input_filename, "rb") as in_f:
+            contents = in_f.read()
+    except Exception as e:
+        die("ERROR: Unable to open library file for reading: %s: %s" % (input_filename, e))
+    filename = cache_filename(cache_dir, "library.json", contents)
+    if filename in loaded_libraries:
+        log_and_print("Read library file from memory: %s" % input_filename)
+        log_library(loaded_libraries[filename])
+        return loaded_libraries[filename]
+    library = read_cache(filename, lambda in_f: library_from_json(json.load(in_f)))
+    if library is not None:
+        log_and_print("Read library file from cache: %s" % input_filename)
+        log_library(library)
+    else:
+        library = read_library(input_filename)
+        write_cache(filename, lambda out_f: out_f.write(json.dumps(library_to_json(library)).encode()))
+    loaded_libraries[filename] = library
+    return library
+
+def read_scantrons_cached(input_filename, N_q, cache_dir, quarantine_filename, layout=None, scantron_hash=None):
+    """(a, section, line, key) = read_scantrons_cached(input_filename, N_q, cache_dir, quarantine_filename,
+                                                       layout=None, scantron_hash=None)
+
+    As for read_scantrons(), but using the cached answer matrix,
+    sections, index and problems if the same Scantron file contents
+    have been read before with the same scanner layout. The Scantrons
+    with problems are written to
+    the quarantine file. If cache_dir is None then the file is always
+    read. The line numbers and keys of the Scantrons are as for
+    parse_scantron_lines(). The scantron_hash is the file_hash() of the
+    file, if it is already known.
+    """
+    if layout is None:
+        layout = read_layout(None)
+    def read(problems):
+        index = []
+        (a, section) = read_scantrons(input_filename, N_q, problems, index=index, layout=layout)
+        line = np.concatenate([np.zeros(0, dtype=np.int64)] + [chunk_line for (chunk_line, chunk_key) in index])
+        key = np.concatenate([np.zeros((0, 2), dtype=np.uint64)] + [chunk_key for (chunk_line, chunk_key) in index])
+        return (a, section, line, key)
+    if cache_dir is None:
+        with open(quarantine_filename, "wb") as quarantine_f:
+            (a, section, line, key) = read(init_problems(quarantine_filename, quarantine_f))
+        count_bytes_written(quarantine_filename)
+        return (a, section, line, key)
+    if scantron_hash is None:
+        scantron_hash = file_hash(input_filename)
+    filename = cache_filename(cache_dir, "scantron.npz", "%d %s" % (N_q, layout.hash), scantron_hash)
+    def read_func(in_f):
+        with np.load(in_f) as cached:
+            problems = init_problems(quarantine_filename)
+            problems.counts = cached["problem_counts"]
+            problems.n_lines = int(cached["problem_lines"])
+            problems.examples = cached["problem_examples"].tolist()
+            problems.n_uncounted = int(cached["problem_uncounted"])
+            return (cached["a"], cached["section"], cached["line"], cached["key"], problems,
+                    cached["quarantine"].tobytes())
+    cached = read_cache(filename, read_func)
+    if cached is not None:
+        (a, section, line, key, problems, quarantine) = cached
+        log_and_print("Read Scantron file from cache: %s" % input_filename)
+        with open(quarantine_filename, "wb") as quarantine_f:
+            quarantine_f.write(quarantine)
+        count_bytes_written(quarantine_filename)
+        report_problems(input_filename, problems)
+        log_array(a, "a", ["N_s", "N_q"])
+        return (a, section, line, key)
+    problems = init_problems(quarantine_filename, io.BytesIO())
+    (a, section, line, key) = read(problems)
+    quarantine = problems.quarantine_f.getvalue()
+    with open(quarantine_filename, "wb") as quarantine_f:
+        quarantine_f.write(quarantine)
+    count_bytes_written(quarantine_filename)
+    write_cache(filename, lambda out_f: np.savez(out_f, a=a, section=section, line=line, key=key,
+                                                 problem_counts=problems.counts,
+                                                 problem_lines=problems.n_lines,
+                                                 problem_examples=np.array(problems.examples, dtype=str),
+                                                 problem_uncounted=problems.n_uncounted,
+                                                 quarantine=np.frombuffer(quarantine, dtype=np.uint8)))
+    return (a, section, line, key)
+
+######################################################################
+######################################################################
+
+# settings of each field in a scanner layout, with their defaults (None
+# for settings that must be given)
+LAYOUT_FIELD_SETTINGS = {
+    "Section": {"offset": None, "width": None, "alphabet": None, "min_length": 0, "strip": False},
+    "Answers": {"offset": None, "width": None, "alphabet": None, "encoding": None},
+}
+
+def read_layout(input_filename):
+    """layout = read_layout(input_filename)
+
+    Read a scanner layout file, which describes the lines of the
+    Scantron file as JSON in the same format as SCANTRON_LAYOUT, and
+    compile it with compile_layout(). If input_filename is None then
+    SCANTRON_LAYOUT is used.
+    """
+    if input_filename is None:
+        return compile_layout("<default layout>", SCANTRON_LAYOUT)
+    log_and_print("Reading scanner layout file: %s" % input_filename)
     with open(input_filename, "r") as in_f:
-        for (i_line, line) in enumerate(in_f):
-            def check_match(s, pattern, offset, field, min_length, strip):
-                if strip:
-                    s = s.strip()
-                cleaned_s = re.sub(pattern, " ", s)
-                if strip:
-                    cleaned_s = cleaned_s.strip()
-                if len(s) == 0 and min_length > 0:
-                    log_and_print("%s:%s: WARNING: field '%s' at character %d is empty"
-                                  % (input_filename, i_line + 1, field, offset + 1))
-                    return cleaned_s
-                if len(s) < min_length:
-                    log_and_print("%s:%s: WARNING: field '%s' at character %d has length %d but should be at least %d: %s"
-                                  % (input_filename, i_line + 1, field, offset + 1, len(s), min_length, s))
-                    return cleaned_s
-                bad_chars = False
-                for match in re.finditer(pattern, s):
-                    bad_chars = True
-                    i = match.start()
-                    log_and_print("%s:%s: WARNING: invalid character '%s' at character %d at position %d in field '%s': %s"
-                                  % (input_filename, i_line + 1, s[i], i + offset + 1, i + 1, field, s))
-                if bad_chars:
-                    return cleaned_s
-                return s
-
-            if len(line) == 1 and ord(line[0]) == 26:
-                # last line has a single char
-                continue
+        return parse_layout(input_filename, in_f.read())
 
-            line_end = 72 + LAST_SCANTRON_QUESTION_NUMBER
+def parse_layout(input_filename, text):
+    """layout = parse_layout(input_filename, text)
 
-            if len(line) < line_end:
-                die("%s:%d: ERROR: line length %d less than expected %d" \
-                        % (input_filename, i_line + 1, len(line), line_end))
+    Parse the JSON text of a scanner layout and compile it with
+    compile_layout().
+    """
+    try:
+        spec = json.loads(text)
+    except ValueError as e:
+        die("ERROR: %s: scanner layout is not valid JSON: %s" % (input_filename, e))
+    return compile_layout(input_filename, spec)
+
+def compile_layout(input_filename, spec):
+    """layout = compile_layout(input_filename, spec)
+
+    Check the scanner layout spec (a dict like SCANTRON_LAYOUT) and
+    compile it into the slices and byte lookup tables used by
+    parse_scantron_lines(), so that every layout is parsed with the
+    same whole-array operations.
+
+    layout.section, layout.answers = the fields, with the settings
+                                     from LAYOUT_FIELD_SETTINGS and
+        field.valid[b] = whether byte b is in the field's alphabet
+        field.pattern = regexp for a character not in the alphabet
+    layout.answer_index[b] = answer index of byte b in the Answers
+                             field, or NO_ANSWER for a blank
+    layout.answer_chars = dict of the answer index of each character
+    layout.terminator = byte of the line that ends the file, or None
+    layout.line_end = shortest line length that has all the fields
+    layout.section_dtype = dtype of the Section field strings
+    layout.hash = hash of the spec, for cache and state files
+    """
+    def error(msg, *args):
+        die("ERROR: %s: scanner layout %s" % (input_filename, msg % args))
+    def is_count(value):
+        return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+    def is_ascii_char(value):
+        return isinstance(value, str) and len(value) == 1 and ord(value) < 128
+    if not isinstance(spec, dict):
+        error("must be a JSON object")
+    for key in spec:
+        if key not in ["name", "terminator", "fields"]:
+            error("has unknown setting '%s'", key)
+    fields = spec.get("fields")
+    if not isinstance(fields, dict):
+        error("must have a \"fields\" object")
+    for name in fields:
+        if name not in LAYOUT_FIELD_SETTINGS:
+            error("has unknown field '%s' (must be one of %s)", name, ", ".join(LAYOUT_FIELD_SETTINGS))
+    layout = Struct()
+    layout.name = str(spec.get("name", input_filename))
+    for (name, defaults) in LAYOUT_FIELD_SETTINGS.items():
+        settings = fields.get(name)
+        if not isinstance(settings, dict):
+            error("must have a \"%s\" field object", name)
+        field = Struct()
+        for key in settings:
+            if key not in defaults:
+                error("field '%s' has unknown setting '%s'", name, key)
+        for (key, default) in defaults.items():
+            if settings.get(key, default) is None:
+                error("field '%s' must have a '%s' setting", name, key)
+            setattr(field, key, settings.get(key, default))
+        for key in ["offset", "width", "min_length"]:
+            if hasattr(field, key) and not is_count(getattr(field, key)):
+                error("field '%s' setting '%s' must be a whole number", name, key)
+        if field.width == 0:
+            error("field '%s' must have a width of at least 1", name)
+        if not (isinstance(field.alphabet, str) and len(field.alphabet) > 0
+                and all(is_ascii_char(c) for c in field.alphabet)):
+            error("field '%s' alphabet must be a string of ASCII characters", name)
+        field.valid = np.zeros(256, dtype=bool)
+        field.valid[list(field.alphabet.encode("ascii"))] = True
+        field.pattern = "[^%s]" % re.escape(field.alphabet)
+        setattr(layout, name.lower(), field)
+    if not isinstance(layout.section.strip, bool):
+        error("field 'Section' setting 'strip' must be true or false")
+    # the encoding is a string with the character for each answer index,
+    # or a JSON object of the answer index for each character
+    encoding = layout.answers.encoding
+    if isinstance(encoding, str):
+        encoding = dict((c, i) for (i, c) in enumerate(encoding))
+    if not isinstance(encoding, dict):
+        error("field 'Answers' encoding must be a string or a JSON object")
+    layout.answer_index = np.full(256, NO_ANSWER, dtype=np.int8)
+    for (c, i) in encoding.items():
+        if not (is_ascii_char(c) and c in layout.answers.alphabet):
+            error("field 'Answers' encoding character %r is not in the alphabet", c)
+        if not (is_count(i) and i < 127):
+            error("field 'Answers' encoding of %r must be an answer index from 0 to 126", c)
+        layout.answer_index[ord(c)] = i
+    layout.answer_chars = encoding
+    terminator = spec.get("terminator")
+    if terminator is not None and not is_ascii_char(terminator):
+        error("terminator must be a single ASCII character or null")
+    layout.terminator = None if terminator is None else ord(terminator)
+    layout.line_end = max(field.offset + field.width for field in [layout.section, layout.answers])
+    layout.section_dtype = "<U%d" % layout.section.width
+    layout.hash = hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+    return layout
+
+######################################################################
+######################################################################
+
+def read_scantron_blocks(input_filename, block_size=None, start=0, end=None, in_f=None):
+    """for (buf, starts, lengths) in read_scantron_blocks(input_filename, block_size=None, start=0, end=None,
+                                                          in_f=None):
+
+    Read the Scantron file as bytes in blocks of about block_size
+    bytes (or all at once if block_size is None), each split into
+    whole lines. Newlines are handled in the same way as for a file
+    opened in text mode ("\r\n" and "\r" both become "\n"). Only the
+    bytes from offset start up to offset end (or the end of the file)
+    are read. If in_f is given then the bytes are read from this
+    binary stream (from its current position, ignoring start) instead
+    of the file. Compressed files (see compression_module()) are
+    decompressed as they are read, and start and end are then offsets
+    in the decompressed bytes.
+
+    buf = the bytes of the block as a 1-D uint8 array
+    starts[l] = offset of the start of line l in buf
+    lengths[l] = number of bytes in line l (including the newline)
+    """
+    pending = np.zeros(0, dtype=np.uint8) # start of a line not yet ended
+    held_cr = False # a block ended with "\r" that might start a "\r\n"
+    with contextlib.ExitStack() as stack:
+        if in_f is None:
+            # large reads, as decompressors otherwise read in small pieces
+            in_f = stack.enter_context(open(input_filename, "rb", buffering=1 << 20))
+        module = compression_module(in_f)
+        if module is not None:
+            in_f = stack.enter_context(module.open(in_f, "rb"))
+        if in_f.seekable() and start > 0:
+            in_f.seek(start)
+        remaining = -1 if end is None else end - start
+        while remaining != 0:
+            if block_size is None or (remaining >= 0 and remaining < block_size):
+                data = in_f.read(remaining)
+            else:
+                data = in_f.read(block_size)
+            if len(data) == 0:
+                break
+            if remaining > 0:
+                remaining -= len(data)
+            raw = np.frombuffer(data, dtype=np.uint8)
+            if held_cr:
+                raw = np.concatenate(([13], raw)).astype(np.uint8)
+            held_cr = (raw[-1] == 13)
+            if held_cr:
+                raw = raw[:-1]
+            buf = np.concatenate((pending, translate_newlines(raw)))
+            newlines = np.flatnonzero(buf == 10)
+            if len(newlines) == 0:
+                pending = buf
+                continue
+            pending = buf[newlines[-1] + 1:]
+            buf = buf[:newlines[-1] + 1]
+            yield (buf,) + split_lines(buf)
+    if held_cr:
+        pending = np.append(pending, np.uint8(10))
+    if len(pending) > 0:
+        yield (pending,) + split_lines(pending)
+
+def compression_module(in_f):
+    """module = compression_module(in_f)
+
+    The module (gzip, lzma or bz2) to decompress the binary stream
+    in_f with, found from the first bytes of the stream without
+    reading past them, or None if it is not compressed (or can't be
+    checked).
+    """
+    if hasattr(in_f, "peek"):
+        head = in_f.peek(8)[:8]
+    elif in_f.seekable():
+        position = in_f.tell()
+        head = in_f.read(8)
+        in_f.seek(position)
+    else:
+        return None
+    for (magic, module) in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return module
+    return None
+
+def translate_newlines(raw):
+    """buf = translate_newlines(raw)
+
+    Convert "\r\n" and "\r" newlines to "\n".
+    """
+    if not (raw == 13).any():
+        return raw
+    crlf = np.flatnonzero((raw[:-1] == 13) & (raw[1:] == 10))
+    buf = np.delete(raw, crlf)
+    buf[buf == 13] = 10
+    return buf
+
+def split_lines(buf):
+    """(starts, lengths) = split_lines(buf)
+
+    Find the start offset and length of each line in buf, with the
+    newline counted as part of the line.
+    """
+    ends = np.flatnonzero(buf == 10) + 1
+    if len(buf) > 0 and buf[-1] != 10:
+        ends = np.append(ends, len(buf))
+    starts = np.concatenate(([0], ends[:-1])).astype(ends.dtype)
+    return (starts, ends - starts)
+
+def line_records(buf, starts, lengths, width):
+    """records = line_records(buf, starts, lengths, width)
+
+    records[l,c] = byte c of line l (including the trailing newline),
+                   padded with zeros beyond the end of the line and
+                   truncated to the given width
+    """
+    if len(lengths) > 1 and (lengths[:-1] == lengths[0]).all() and lengths[0] >= width:
+        # fixed-width records (except maybe the last line with Ctrl-Z):
+        # view the buffer directly as a matrix
+        records = np.zeros((len(lengths), width), dtype=np.uint8)
+        records[:-1] = buf[:starts[-1]].reshape(-1, lengths[0])[:, :width]
+        last = buf[starts[-1]:starts[-1] + width]
+        records[-1, :len(last)] = last
+    else:
+        # each line is a row of a sliding window view of the buffer, so
+        # only the records themselves are allocated, and the bytes past
+        # the end of the short lines are then cleared
+        padded = np.concatenate((buf, np.zeros(width, dtype=np.uint8)))
+        records = np.lib.stride_tricks.sliding_window_view(padded, width)[starts]
+        short = np.flatnonzero(lengths < width)
+        if len(short) > 0:
+            records[short] *= (np.arange(width) < lengths[short, None])
+    return records
+
+# problems found in Scantron lines, as (field, error)
+SCANTRON_PROBLEMS = [("Line", "too short"), ("Section", "empty"), ("Section", "too short"),
+                     ("Section", "invalid character"), ("Answers", "invalid character")]
+
+def record_keys(records):
+    """key = record_keys(records)
+
+    Hash each row of the records from line_records() with whole-array
+    operations, so that identical lines have the same key and
+    different lines almost never do.
+
+    key[l,:] = two 64-bit hashes of line l
+    """
+    (n_lines, width) = records.shape
+    words = np.zeros((n_lines, -(-width // 8) * 8), dtype=np.uint8)
+    words[:, :width] = records
+    words = words.view("<u8")
+    # fixed random odd multipliers for each 8-byte word of the line
+    multipliers = np.random.default_rng(0x5ca17).integers(0, 2**63, size=(2, words.shape[1]),
+                                                           dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    key = np.empty((n_lines, 2), dtype=np.uint64)
+    for i in range(2):
+        h = (words * multipliers[i]).sum(axis=1, dtype=np.uint64)
+        key[:, i] = h ^ (h >> np.uint64(29))
+    return key
+
+def check_scantron_field(input_filename, i_line, s, pattern, offset, field, min_length, strip):
+    """(cleaned_s, problems) = check_scantron_field(input_filename, i_line, s, pattern, offset, field,
+                                                    min_length, strip)
+
+    Check a single field of a Scantron line for characters that match
+    the pattern. Returns the field with the bad characters replaced by
+    spaces and a list of (problem, message) for the problems found,
+    where problem is one of SCANTRON_PROBLEMS.
+    """
+    if strip:
+        s = s.strip()
+    cleaned_s = re.sub(pattern, " ", s)
+    if strip:
+        cleaned_s = cleaned_s.strip()
+    if len(s) == 0 and min_length > 0:
+        return (cleaned_s, [((field, "empty"), "%s:%s: WARNING: field '%s' at character %d is empty"
+                             % (input_filename, i_line + 1, field, offset + 1))])
+    if len(s) < min_length:
+        return (cleaned_s, [((field, "too short"),
+                             "%s:%s: WARNING: field '%s' at character %d has length %d but should be at least %d: %s"
+                             % (input_filename, i_line + 1, field, offset + 1, len(s), min_length, s))])
+    problems = []
+    for match in re.finditer(pattern, s):
+        i = match.start()
+        problems.append(((field, "invalid character"),
+                         "%s:%s: WARNING: invalid character '%s' at character %d at position %d in field '%s': %s"
+                         % (input_filename, i_line + 1, s[i], i + offset + 1, i + 1, field, s)))
+    if len(problems) > 0:
+        return (cleaned_s, problems)
+    return (s, problems)
+
+def check_scantron_line(input_filename, i_line, line, N_q, layout):
+    """(section, answers, problems) = check_scantron_line(input_filename, i_line, line, N_q, layout)
+
+    Check and decode a single Scantron line with the scanner layout
+    from compile_layout(), one character at a time. This is only used
+    for the lines that parse_scantron_lines() can't handle with
+    whole-array operations, and to describe the problems in the
+    example lines.
+
+    answers[q] = index of the answer to question q (0 = A, 1 = B, etc),
+                 or NO_ANSWER for a blank or invalid answer
+    problems = list of (problem, message) as for check_scantron_field()
+    """
+    if len(line) < layout.line_end:
+        return (None, None, [(("Line", "too short"), "%s:%d: WARNING: line length %d less than expected %d"
+                              % (input_filename, i_line + 1, len(line), layout.line_end))])
+
+    field = layout.section
+    (section, section_problems) = check_scantron_field(input_filename, i_line,
+                                                       line[field.offset:field.offset + field.width],
+                                                       field.pattern, field.offset, "Section", field.min_length,
+                                                       field.strip)
+    field = layout.answers
+    (answers, answer_problems) = check_scantron_field(input_filename, i_line, line[field.offset:field.offset + N_q],
+                                                      field.pattern, field.offset, "Answers", 0, False)
+
+    answers = [layout.answer_chars.get(c, NO_ANSWER) for c in answers]
+    return (section, answers, section_problems + answer_problems)
+
+def scantron_problems(layout, lengths, section_bytes, answer_bytes):
+    """problem = scantron_problems(layout, lengths, section_bytes, answer_bytes)
+
+    Find the problems in a block of Scantron lines with whole-array
+    operations on the bytes of the Section and Answers fields, looking
+    up each byte in the alphabets of the scanner layout, in the same
+    way as check_scantron_line() for lines that are entirely ASCII.
+
+    problem[l,k] = whether line l has problem SCANTRON_PROBLEMS[k]
+    """
+    short = lengths < layout.line_end
+    field = layout.section
+    if field.strip:
+        # the Section field is stripped of whitespace before it is checked
+        is_space = np.array([b < 128 and chr(b).isspace() for b in range(256)])
+        non_space = ~is_space[section_bytes]
+        first = non_space.argmax(axis=1)
+        last = section_bytes.shape[1] - non_space[:, ::-1].argmax(axis=1)
+        section_length = np.where(non_space.any(axis=1), last - first, 0)
+        cols = np.arange(section_bytes.shape[1])
+        inside = (cols >= first[:, None]) & (cols < last[:, None])
+    else:
+        section_length = np.full(len(lengths), section_bytes.shape[1])
+        inside = True
+    section_empty = (section_length == 0) & (field.min_length > 0)
+    section_short = ~section_empty & (section_length < field.min_length)
+    section_valid = ~(inside & ~field.valid[section_bytes]).any(axis=1)
+    answers_valid = layout.answers.valid[answer_bytes].all(axis=1)
+    # in the order of SCANTRON_PROBLEMS
+    return np.stack([short,
+                     ~short & section_empty,
+                     ~short & section_short,
+                     ~short & ~section_empty & ~section_short & ~section_valid,
+                     ~short & ~answers_valid], axis=1)
+
+def init_problems(quarantine_filename=None, quarantine_f=None):
+    """problems = init_problems(quarantine_filename=None, quarantine_f=None)
+
+    Start collecting the problems found by parse_scantron_lines(). The
+    lines with problems are written to the binary stream quarantine_f
+    (if it is not None), which is the file quarantine_filename.
+
+    problems.counts[k] = number of lines with problem SCANTRON_PROBLEMS[k]
+    problems.n_lines = number of lines with any problem
+    problems.examples = messages about the first VALIDATION_EXAMPLES
+                        lines with problems
+    problems.n_uncounted = number of answers with an index of N_a or
+                           more (like digits 6 to 9), which are read
+                           but not counted in the statistics
+    """
+    return Struct(counts=np.zeros(len(SCANTRON_PROBLEMS), dtype=np.int64), n_lines=0, examples=[],
+                  n_uncounted=0, quarantine_filename=quarantine_filename, quarantine_f=quarantine_f)
 
-            section = check_match(line[60:63], "[^0-9]", 60, "Section", 3, True)
-            answers = check_match(line[72:72 + N_q], "[^0-9 ]", 72, "Answers", 0, False)
+def record_problems(problems, input_filename, first_line, buf, starts, lengths, N_q, layout, problem, bad):
+    """record_problems(problems, input_filename, first_line, buf, starts, lengths, N_q, layout, problem, bad)
 
-            answers = ["*" if c == " " else ind2chr(int(c) - 1)
-                       for c in answers]
-            log("%s:%s: section %s"
-                % (input_filename, i_line + 1, section))
+    Add the bad lines of a block from parse_scantron_lines() to the
+    problems from init_problems(), where problem is as from
+    scantron_problems(). Only the example lines are checked one at a
+    time for messages (and all bad lines at the debug log level).
+    """
+    bad_lines = np.flatnonzero(bad)
+    if len(bad_lines) == 0:
+        return
+    problems.counts += problem[bad].sum(axis=0)
+    if problems.quarantine_f is not None:
+        problems.quarantine_f.write(buf[np.repeat(bad, lengths)].tobytes())
+    n_examples = max(0, min(len(bad_lines), VALIDATION_EXAMPLES - problems.n_lines))
+    if log_enabled(LOG_DEBUG):
+        n_messages = len(bad_lines)
+    else:
+        n_messages = n_examples
+    encoding = locale.getpreferredencoding(False)
+    for (j, i) in enumerate(bad_lines[:n_messages]):
+        line = buf[starts[i]:starts[i] + lengths[i]].tobytes().decode(encoding, errors="replace")
+        (section, answers, line_problems) = check_scantron_line(input_filename, first_line + i, line, N_q, layout)
+        messages = [message for (p, message) in line_problems]
+        if j < n_examples:
+            problems.examples += messages
+        else:
+            log_debug("\n".join(messages))
+    problems.n_lines += len(bad_lines)
+    count_metric("sheets_quarantined", len(bad_lines))
 
-            a_data.append(list(answers))
+def report_problems(input_filename, problems):
+    """report_problems(input_filename, problems)
 
-    a = np.array(a_data, dtype=str)
+    Show the example lines and the counts of each problem found while
+    reading the Scantron file.
+    """
+    if problems.n_uncounted > 0:
+        log_and_print("%s: WARNING: %d answers after answer %s are not counted in the statistics"
+                      % (input_filename, problems.n_uncounted, ind2chr(N_a - 1)), level=LOG_WARNING)
+    if problems.n_lines == 0:
+        log("No problems found in Scantron file")
+        return
+    for message in problems.examples:
+        log_and_print(message, level=LOG_WARNING)
+    if problems.n_lines > VALIDATION_EXAMPLES:
+        log_and_print("%s: WARNING: %d more Scantrons with problems are not shown"
+                      % (input_filename, problems.n_lines - VALIDATION_EXAMPLES), level=LOG_WARNING)
+    if problems.quarantine_filename is None:
+        destination = "left out"
+    else:
+        destination = "left out and written to %s" % problems.quarantine_filename
+    log_and_print("%s: WARNING: %d Scantrons with problems were %s"
+                  % (input_filename, problems.n_lines, destination), level=LOG_WARNING)
+    for ((field, error), count) in zip(SCANTRON_PROBLEMS, problems.counts):
+        if count > 0:
+            log_and_print("    %s %s: %d" % (field, error, count))
+
+def read_scantron_chunks(input_filename, N_q, chunk_size=None, in_f=None, problems=None, index=None, layout=None):
+    """for (a, section) in read_scantron_chunks(input_filename, N_q, chunk_size=None, in_f=None, problems=None,
+                                                index=None, layout=None):
+
+    Read the Scantron file in chunks of about chunk_size Scantrons (or
+    all at once if chunk_size is None), so that memory use depends on
+    the chunk size and not the length of the file.
+
+    a[s,q] = index of the answer given by student s in the chunk to
+             question q (0 = A, 1 = B, etc), or NO_ANSWER if blank or
+             invalid
+    section[s] = Section field of the Scantron of student s
+
+    Each chunk is read as a uint8 record matrix and the Section and
+    Answers fields (at the offsets in the scanner layout from
+    compile_layout(), or SCANTRON_LAYOUT if layout is None) are
+    checked with whole-array masks. Lines with problems (bad
+    characters, short lines) are left out and added to problems (from
+    init_problems()).
+
+    If in_f is given then it is read instead of the file, as for
+    read_scantron_blocks(). The index is as for
+    parse_scantron_lines().
+    """
+    if layout is None:
+        layout = read_layout(None)
+    if N_q > layout.answers.width:
+        die("ERROR: %d questions but Scantrons only have %d" % (N_q, layout.answers.width))
+    if problems is None:
+        problems = init_problems()
+    first_line = 0
+    for (buf, starts, lengths) in read_scantron_blocks(input_filename, scantron_block_size(chunk_size, layout),
+                                                       in_f=in_f):
+        yield parse_scantron_lines(input_filename, first_line, buf, starts, lengths, N_q, layout, problems, index)
+        first_line += len(lengths)
+
+def scantron_block_size(chunk_size, layout):
+    """block_size = scantron_block_size(chunk_size, layout)
+
+    The number of bytes to read for about chunk_size Scantrons with
+    the scanner layout, or None to read everything at once if
+    chunk_size is None.
+    """
+    if chunk_size is None:
+        return None
+    return chunk_size * (layout.line_end + 2)
+
+def parse_scantron_lines(input_filename, first_line, buf, starts, lengths, N_q, layout, problems, index=None):
+    """(a, section) = parse_scantron_lines(input_filename, first_line, buf, starts, lengths, N_q, layout,
+                                           problems, index=None)
+
+    Parse a block of lines from read_scantron_blocks(), where the
+    first line in the block is line number first_line in the file,
+    with the scanner layout from compile_layout(). The fields are
+    slices of the record matrix and the answers are found with the
+    layout's lookup table, so every layout is parsed at the same
+    speed. Lines with problems are left out of a and section, and are
+    added to problems (from init_problems()) instead. If index is a
+    list then (line, key) is appended to it, where
+
+    line[s] = line number in the file of student s in the block
+    key[s,:] = record_keys() of the raw line of student s
+    """
+    records = line_records(buf, starts, lengths, layout.line_end)
+
+    # last line has a single terminator char (Ctrl-Z)
+    keep = np.ones(len(lengths), dtype=bool)
+    if layout.terminator is not None:
+        keep &= ~((lengths == 1) & (records[:, 0] == layout.terminator))
+
+    field = layout.section
+    section_bytes = records[:, field.offset:field.offset + field.width]
+    answer_bytes = records[:, layout.answers.offset:layout.answers.offset + N_q]
+    problem = scantron_problems(layout, lengths, section_bytes, answer_bytes)
+
+    # answer characters (like digits 1, 2, ...) become answers 0 = A, 1 = B, ... and all else is blank
+    a = layout.answer_index[answer_bytes]
+    sections = section_bytes.copy().view("S%d" % field.width).ravel().astype(layout.section_dtype)
+    if field.strip and field.min_length < field.width:
+        # only then can a valid Section have whitespace around it
+        sections = np.char.strip(sections)
+
+    # only lines that are entirely ASCII have one character per byte,
+    # so the others are checked one at a time
+    if (buf >= 128).any():
+        non_ascii = np.zeros(len(lengths), dtype=bool)
+        line_index = np.repeat(np.arange(len(lengths)), lengths)
+        non_ascii[line_index[buf >= 128]] = True
+        encoding = locale.getpreferredencoding(False)
+        for i in np.flatnonzero(keep & non_ascii):
+            line = buf[starts[i]:starts[i] + lengths[i]].tobytes().decode(encoding, errors="replace")
+            (section, answers, line_problems) = check_scantron_line(input_filename, first_line + i, line, N_q,
+                                                                    layout)
+            problem[i, :] = False
+            for (p, message) in line_problems:
+                problem[i, SCANTRON_PROBLEMS.index(p)] = True
+            if len(line_problems) == 0:
+                a[i, :] = answers
+                sections[i] = section
+
+    bad = keep & problem.any(axis=1)
+    record_problems(problems, input_filename, first_line, buf, starts, lengths, N_q, layout, problem, bad)
+    keep &= ~bad
+
+    if log_enabled(LOG_DEBUG):
+        msgs = ["%s:%s: section %s" % (input_filename, first_line + i + 1, sections[i])
+                for i in np.flatnonzero(keep)]
+        if len(msgs) > 0:
+            log_debug("\n".join(msgs))
+
+    if index is not None:
+        index.append((first_line + np.flatnonzero(keep) + 1, record_keys(records[keep])))
+
+    count_metric("sheets_read", keep.sum())
+    (a, sections) = (a[keep], sections[keep])
+    problems.n_uncounted += int(np.count_nonzero(a >= N_a))
+    return (a, sections)
+
+def read_scantrons(input_filename, N_q, problems=None, in_f=None, index=None, layout=None):
+    """(a, section) = read_scantrons(input_filename, N_q, problems=None, in_f=None, index=None, layout=None)
+
+    Read the scantron data arrays from scantron.dat, or from the
+    binary stream in_f if it is given, with the scanner layout from
+    compile_layout() (or SCANTRON_LAYOUT if layout is None). Scantrons
+    with problems are left out and added to problems (from
+    init_problems()), which are then reported. The index is as for
+    parse_scantron_lines().
+
+    a[s,q] = index of the answer given by student s to question q
+             (0 = A, 1 = B, etc), or NO_ANSWER if blank or invalid
+    section[s] = Section field of the Scantron of student s
+    """
+    log_and_print("Reading Scantron file: %s" % input_filename)
+    if problems is None:
+        problems = init_problems()
+    if layout is None:
+        layout = read_layout(None)
+    a = np.zeros((0, N_q), dtype=np.int8)
+    section = np.zeros(0, dtype=layout.section_dtype)
+    chunks = list(read_scantron_chunks(input_filename, N_q, in_f=in_f, problems=problems, index=index,
+                                       layout=layout))
+    if len(chunks) > 0:
+        a = np.concatenate([chunk_a for (chunk_a, chunk_section) in chunks])
+        section = np.concatenate([chunk_section for (chunk_a, chunk_section) in chunks])
+    report_problems(input_filename, problems)
     log_array(a, "a", ["N_s", "N_q"])
     log("Successfully completed reading Scantron file")
-    return a
+    return (a, section)
 
 ######################################################################
 ######################################################################
 
-def filter_scantrons(a, filter_q, filter_a):
-    """new_a = filter_scantrons(a, filter_q, filter_a)
+def find_duplicates(a, section, key):
+    """(duplicate, first) = find_duplicates(a, section, key)
 
-    Only keep scantrons which have question number 'filter_q' with
-    answer equal to 'answer_q'.
+    Find the Scantrons that are the same as an earlier Scantron (such
+    as a stack that was scanned twice), by grouping the raw line keys
+    from record_keys() with np.unique() rather than comparing every
+    pair. Grouped Scantrons are also checked to have the same answers
+    and section.
 
-    new_a[s,q] = answer given by student s to question q
+    duplicate[s] = whether student s is a duplicate of an earlier one
+    first[s] = the first student with the same key as student s
     """
-    (N_s, N_q) = a.shape
-    qi = filter_q - 1
-    if qi < 0 or qi >= N_q:
-        raise Exception("filter_q = %d out of range (must be between 1 and %d)" % (filter_q, N_q))
-    new_a_data = []
-    for si in range(N_s):
-        if a[si, qi] == filter_a:
-            new_a_data.append(a[si,:])
-    if len(new_a_data) == 0:
+    if len(key) == 0:
+        return (np.zeros(0, dtype=bool), np.zeros(0, dtype=np.intp))
+    rows = np.ascontiguousarray(key).view(np.dtype((np.void, key.itemsize * key.shape[1]))).ravel()
+    (unique_rows, first_index, inverse) = np.unique(rows, return_index=True, return_inverse=True)
+    first = first_index[inverse.ravel()]
+    duplicate = (first != np.arange(len(key))) & (a == a[first]).all(axis=1) & (section == section[first])
+    return (duplicate, first)
+
+def dedup_scantrons(a, section, line, key, drop=False):
+    """(new_a, new_section) = dedup_scantrons(a, section, line, key, drop=False)
+
+    Report the clusters of duplicate Scantrons found by
+    find_duplicates(), with their line numbers, and leave out all but
+    the first Scantron of each cluster if drop is True.
+    """
+    log_and_print("Checking for duplicate Scantrons")
+    (duplicate, first) = find_duplicates(a, section, key)
+    n_duplicates = int(duplicate.sum())
+    count_metric("duplicates", n_duplicates)
+    if n_duplicates == 0:
+        log("No duplicate Scantrons found")
+        return (a, section)
+    originals = np.unique(first[duplicate])
+    # line numbers of the clusters that are shown (or all of them when
+    # debugging), each starting with the first of the cluster
+    shown = originals if log_enabled(LOG_DEBUG) else originals[:VALIDATION_EXAMPLES]
+    rows = np.flatnonzero((duplicate | (first == np.arange(len(a)))) & np.isin(first, shown))
+    rows = rows[np.argsort(first[rows], kind="stable")]
+    clusters = np.split(line[rows], np.flatnonzero(np.diff(first[rows])) + 1)
+    for cluster in clusters[:VALIDATION_EXAMPLES]:
+        log_and_print("WARNING: duplicate Scantrons at lines %s" % ", ".join(map(str, cluster)), level=LOG_WARNING)
+    if len(originals) > VALIDATION_EXAMPLES:
+        log_and_print("WARNING: %d more clusters of duplicate Scantrons are not shown"
+                      % (len(originals) - VALIDATION_EXAMPLES), level=LOG_WARNING)
+        if log_enabled(LOG_DEBUG):
+            log_debug("\n".join("duplicate Scantrons at lines %s" % ", ".join(map(str, cluster))
+                                for cluster in clusters[VALIDATION_EXAMPLES:]))
+    if drop:
+        log_and_print("WARNING: dropped %d duplicate Scantrons in %d clusters" % (n_duplicates, len(originals)),
+                      level=LOG_WARNING)
+        (a, section) = (a[~duplicate], section[~duplicate])
+        log_array(a, "a", ["N_s", "N_q"])
+    else:
+        log_and_print("WARNING: %d duplicate Scantrons in %d clusters are included (use --drop-duplicates to"
+                      " leave them out)" % (n_duplicates, len(originals)), level=LOG_WARNING)
+    log("Successfully completed checking for duplicate Scantrons")
+    return (a, section)
+
+def filter_scantrons(a, section, filters):
+    """(new_a, new_section) = filter_scantrons(a, section, filters)
+
+    Only keep scantrons which, for every (filter_q, filter_a) in
+    filters, have question number 'filter_q' with answer index equal
+    to 'filter_a' (0 = A, 1 = B, etc).
+
+    new_a[s,q] = index of the answer given by student s to question q
+    new_section[s] = Section field of the Scantron of student s
+    """
+    keep = filter_mask(a, filters)
+    new_a = a[keep]
+    new_section = section[keep]
+    count_metric("rows_filtered", a.shape[0] - new_a.shape[0])
+    if new_a.shape[0] == 0:
         raise Exception("after filtering no scantrons were left")
-    new_a = np.array(new_a_data, dtype=str)
     log_array(new_a, "new_a", ["N_s", "N_q"])
     log("Successfully completed filtering Scantron data")
-    return new_a
+    return (new_a, new_section)
+
+def filter_mask(a, filters):
+    """keep = filter_mask(a, filters)
+
+    keep[s] = whether student s matches all of the filters, as for
+              filter_scantrons()
+    """
+    (N_s, N_q) = a.shape
+    keep = np.ones(N_s, dtype=bool)
+    for (filter_q, filter_a) in filters:
+        qi = filter_q - 1
+        if qi < 0 or qi >= N_q:
+            raise Exception("filter_q = %d out of range (must be between 1 and %d)" % (filter_q, N_q))
+        keep &= (a[:, qi] == filter_a)
+    return keep
+
+def stream_scantrons(input_filename, answers_filename, data_dir, quarantine_filename, library, N_q, N_a,
+                     filters=[], chunk_size=10000, cooccurrence=False, layout=None):
+    """(n_s_qa, N_s, n_s_qaqa) = stream_scantrons(input_filename, answers_filename, data_dir, quarantine_filename,
+                                                  library, N_q, N_a, filters=[], chunk_size=10000,
+                                                  cooccurrence=False, layout=None)
+
+    Read the Scantron file in chunks of chunk_size Scantrons, writing
+    the answers CSV file and the binary answers and sections in
+    data_dir and counting the answers as each chunk is read, so that
+    only one chunk is ever in memory. The Scantrons are filtered in the
+    same way as filter_scantrons(), and Scantrons with problems are
+    written to the quarantine file. The layout is as for
+    read_scantrons().
+
+    n_s_qa[q,a] = number of students giving answer a to question q
+    N_s = number of students
+    n_s_qaqa = co-occurrence counts of all Scantrons (before filtering)
+               if cooccurrence is True, or None otherwise
+    """
+    log_and_print("Streaming Scantron file: %s" % input_filename)
+    log_and_print("Writing answers CSV file: %s" % answers_filename)
+    if layout is None:
+        layout = read_layout(None)
+    n_s_qa = np.zeros((N_q, N_a), dtype=np.int64)
+    N_s = 0
+    n_s_qaqa = np.zeros((N_q, N_a, N_q, N_a), dtype=np.int64) if cooccurrence else None
+    os.makedirs(data_dir, exist_ok=True)
+    a_f = open_npy_rows(os.path.join(data_dir, "a.npy"), np.int8, (N_q,))
+    section_f = open_npy_rows(os.path.join(data_dir, "section.npy"), layout.section_dtype, ())
+    with open(answers_filename, "w") as out_f, open(quarantine_filename, "wb") as quarantine_f:
+        problems = init_problems(quarantine_filename, quarantine_f)
+        write_answers_header(out_f, library)
+        for (a, section) in read_scantron_chunks(input_filename, N_q, chunk_size, problems=problems, layout=layout):
+            if cooccurrence:
+                n_s_qaqa += count_cooccurrence(a, N_a)
+            keep = filter_mask(a, filters)
+            count_metric("rows_filtered", a.shape[0] - keep.sum())
+            (a, section) = (a[keep], section[keep])
+            write_answers_rows(out_f, a)
+            a_f.write(a.tobytes())
+            section_f.write(section.tobytes())
+            n_s_qa += count_answers(a, N_a)
+            N_s += a.shape[0]
+    close_npy_rows(a_f, np.int8, (N_q,), N_s)
+    close_npy_rows(section_f, layout.section_dtype, (), N_s)
+    count_bytes_written(answers_filename, os.path.join(data_dir, "a.npy"), os.path.join(data_dir, "section.npy"),
+                        quarantine_filename)
+    report_problems(input_filename, problems)
+    if N_s == 0 and len(filters) > 0:
+        raise Exception("after filtering no scantrons were left")
+    log("Read %d Scantrons" % N_s)
+    log("Successfully completed streaming Scantron file")
+    return (n_s_qa, N_s, n_s_qaqa)
+
+def ingest_scantrons(state_filename, input_filename, answers_filename, data_dir, quarantine_filename, library,
+                     N_q, N_a, chunk_size=None, layout=None):
+    """(n_s_qa, N_s) = ingest_scantrons(state_filename, input_filename, answers_filename, data_dir,
+                                        quarantine_filename, library, N_q, N_a, chunk_size=None, layout=None)
+
+    Read only the Scantrons that have been appended to the Scantron
+    file since the last run, adding them to the answer counts, the
+    answers CSV file, the binary answers and sections in data_dir,
+    and the quarantine file (for Scantrons with problems) from the
+    last run. These are kept in the state
+    file, together with the byte offset reached and a checksum of the
+    file up to that offset. If the state file is missing or the file
+    has changed before that offset (or the questions or the scanner
+    layout have changed) then everything is read again. Only the
+    problems in the new Scantrons are reported. The layout is as for
+    read_scantrons().
+
+    Only whole lines (ending in a newline) are added to the state, so
+    a last line without a newline (such as the Ctrl-Z line) is read
+    again on the next run.
+
+    n_s_qa[q,a] = number of students giving answer a to question q
+    N_s = number of students
+    """
+    log_and_print("Reading new Scantrons from file: %s" % input_filename)
+    with open(input_filename, "rb") as in_f:
+        if compression_module(in_f) is not None:
+            die("ERROR: --incremental can't be used with a compressed Scantron file: %s" % input_filename)
+    if layout is None:
+        layout = read_layout(None)
+    header = io.StringIO()
+    write_answers_header(header, library)
+    header_hash = hashlib.sha1((header.getvalue() + layout.hash).encode()).hexdigest()
+    file_size = os.path.getsize(input_filename)
+    a_filename = os.path.join(data_dir, "a.npy")
+    section_filename = os.path.join(data_dir, "section.npy")
+    state = read_scantron_state(state_filename, input_filename, answers_filename, quarantine_filename,
+                                header_hash, file_size)
+    if state is not None and not (npy_rows_exist(a_filename, np.int8, (N_q,), state.N_s)
+                                  and npy_rows_exist(section_filename, layout.section_dtype, (), state.N_s)):
+        log_and_print("Binary answers have changed since Scantron state file was written: %s" % data_dir)
+        state = None
+    if state is None:
+        log_and_print("Reading all Scantrons from the start of the file")
+        state = Struct()
+        state.offset = 0
+        state.n_lines = 0
+        state.N_s = 0
+        state.n_s_qa = np.zeros((N_q, N_a), dtype=np.int64)
+        with open(answers_filename, "w") as out_f:
+            out_f.write(header.getvalue())
+            state.answers_size = out_f.tell()
+        open(quarantine_filename, "wb").close()
+        state.quarantine_size = 0
+    else:
+        log_and_print("Skipping %d Scantrons already read up to byte %d" % (state.N_s, state.offset))
+    if state.n_s_qa.shape != (N_q, N_a):
+        die("ERROR: Scantron state file %s has the wrong number of questions or answers" % state_filename)
+    end = last_line_end(input_filename, state.offset, file_size)
+
+    os.makedirs(data_dir, exist_ok=True)
+    a_f = open_npy_rows(a_filename, np.int8, (N_q,), state.N_s)
+    section_f = open_npy_rows(section_filename, layout.section_dtype, (), state.N_s)
+    (answers_size, quarantine_size, N_s) = (state.answers_size, state.quarantine_size, state.N_s)
+    with open(answers_filename, "r+") as out_f, open(quarantine_filename, "r+b") as quarantine_f:
+        out_f.truncate(state.answers_size)
+        out_f.seek(state.answers_size)
+        quarantine_f.truncate(state.quarantine_size)
+        quarantine_f.seek(state.quarantine_size)
+        problems = init_problems(quarantine_filename, quarantine_f)
+        block_size = scantron_block_size(chunk_size, layout)
+        for (start, stop, save) in [(state.offset, end, True), (end, file_size, False)]:
+            for (buf, starts, lengths) in read_scantron_blocks(input_filename, block_size, start, stop):
+                (a, section) = parse_scantron_lines(input_filename, state.n_lines, buf, starts, lengths, N_q,
+                                                    layout, problems)
+                state.n_lines += len(lengths)
+                write_answers_rows(out_f, a)
+                a_f.write(a.tobytes())
+                section_f.write(section.tobytes())
+                state.n_s_qa += count_answers(a, N_a)
+                state.N_s += a.shape[0]
+            if save:
+                state.offset = end
+                out_f.flush()
+                state.answers_size = out_f.tell()
+                state.quarantine_size = quarantine_f.tell()
+                write_scantron_state(state_filename, input_filename, state, header_hash)
+    close_npy_rows(a_f, np.int8, (N_q,), state.N_s)
+    close_npy_rows(section_f, layout.section_dtype, (), state.N_s)
+    count_metric("bytes_written", os.path.getsize(answers_filename) - answers_size
+                 + os.path.getsize(quarantine_filename) - quarantine_size
+                 + (state.N_s - N_s) * (npy_row_bytes(np.int8, (N_q,)) + npy_row_bytes(layout.section_dtype, ())))
+    report_problems(input_filename, problems)
+    log("Read %d Scantrons" % state.N_s)
+    log("Successfully completed reading new Scantrons")
+    return (state.n_s_qa, state.N_s)
+
+def last_line_end(input_filename, start, end):
+    """offset = last_line_end(input_filename, start, end)
+
+    The offset just after the last newline in the file between offsets
+    start and end, or start if there is no newline.
+    """
+    block_size = 65536
+    with open(input_filename, "rb") as in_f:
+        while end > start:
+            block_start = max(start, end - block_size)
+            in_f.seek(block_start)
+            i = in_f.read(end - block_start).rfind(b"\n")
+            if i >= 0:
+                return block_start + i + 1
+            end = block_start
+    return start
+
+def prefix_hash(input_filename, end):
+    """h = prefix_hash(input_filename, end)
+
+    The SHA-1 hex digest of the first 'end' bytes of the file.
+    """
+    h = hashlib.sha1()
+    with open(input_filename, "rb") as in_f:
+        remaining = end
+        while remaining > 0:
+            data = in_f.read(min(remaining, 1 << 20))
+            if len(data) == 0:
+                break
+            h.update(data)
+            remaining -= len(data)
+    return h.hexdigest()
+
+def read_scantron_state(state_filename, input_filename, answers_filename, quarantine_filename, header_hash,
+                        file_size):
+    """state = read_scantron_state(state_filename, input_filename, answers_filename, quarantine_filename,
+                                   header_hash, file_size)
+
+    Read the state saved by write_scantron_state(), or return None if
+    there is no saved state or it no longer matches the Scantron file,
+    the answers CSV file, the quarantine file, or the question texts.
+    """
+    try:
+        with np.load(state_filename) as saved:
+            state = Struct()
+            state.offset = int(saved["offset"])
+            state.n_lines = int(saved["n_lines"])
+            state.N_s = int(saved["N_s"])
+            state.n_s_qa = saved["n_s_qa"]
+            state.answers_size = int(saved["answers_size"])
+            state.quarantine_size = int(saved["quarantine_size"])
+            scantron_hash = str(saved["scantron_hash"])
+            saved_header_hash = str(saved["header_hash"])
+    except (OSError, KeyError, ValueError):
+        return None
+    if saved_header_hash != header_hash:
+        log_and_print("Questions or scanner layout have changed since Scantron state file was written: %s" % state_filename)
+        return None
+    if not os.path.isfile(answers_filename) or os.path.getsize(answers_filename) < state.answers_size:
+        log_and_print("Answers CSV file has changed since Scantron state file was written: %s" % answers_filename)
+        return None
+    if not os.path.isfile(quarantine_filename) or os.path.getsize(quarantine_filename) < state.quarantine_size:
+        log_and_print("Quarantine file has changed since Scantron state file was written: %s" % quarantine_filename)
+        return None
+    if file_size < state.offset or prefix_hash(input_filename, state.offset) != scantron_hash:
+        log_and_print("Scantron file has changed since Scantron state file was written: %s" % input_filename)
+        return None
+    return state
+
+def write_scantron_state(state_filename, input_filename, state, header_hash):
+    """write_scantron_state(state_filename, input_filename, state, header_hash)
+
+    Save the state for ingest_scantrons().
+    """
+    log("Writing Scantron state file: %s" % state_filename)
+    tmp_filename = state_filename + ".tmp"
+    with open(tmp_filename, "wb") as out_f:
+        np.savez(out_f, offset=state.offset, n_lines=state.n_lines, N_s=state.N_s,
+                 n_s_qa=state.n_s_qa, answers_size=state.answers_size, quarantine_size=state.quarantine_size,
+                 scantron_hash=prefix_hash(input_filename, state.offset),
+                 header_hash=header_hash)
+    os.replace(tmp_filename, state_filename)
 
 ######################################################################
 ######################################################################
@@ -386,26 +2198,395 @@ def write_answers(output_filename, library, a, N_a):
     Write per-student answers to the answers.csv file.
     """
     log_and_print("Writing answers CSV file: %s" % output_filename)
-    (N_s, N_q) = a.shape
     with open(output_filename, "w") as out_f:
+        write_answers_header(out_f, library)
+        write_answers_rows(out_f, a)
+    count_bytes_written(output_filename)
+    log("Successfully completed writing answers CSV file")
+
+def write_answers_header(out_f, library):
+    """write_answers_header(out_f, library)
+
+    Write the header line of question texts to the answers.csv file.
+    """
+    qi = 0
+    for zone in library.zones:
+        for question in zone.questions:
+            if qi > 0:
+                out_f.write(",")
+            out_f.write('"%d. %s"' % (qi + 1, question.body))
+            qi += 1
+    out_f.write('\n')
+
+def write_answers_rows(out_f, a, block_size=65536):
+    """write_answers_rows(out_f, a, block_size=65536)
+
+    Write one line per student in a to the answers.csv file.
+
+    Each block of block_size students is formatted as a single byte
+    matrix with the digits of each answer index (as many as the
+    largest index in the block needs) followed by a comma (or
+    newline). Blank answers and leading zeros are then removed and the
+    whole block is written at once.
+    """
+    (N_s, N_q) = a.shape
+    if N_q == 0:
+        out_f.write("\n" * N_s)
+        return
+    for start in range(0, N_s, block_size):
+        block = np.asarray(a[start:start + block_size])
+        n_digits = len(str(max(int(block.max()), 0)))
+        chars = np.empty((block.shape[0], N_q, n_digits + 1), dtype=np.uint8)
+        keep = np.ones(chars.shape, dtype=bool)
+        if n_digits == 1:
+            chars[:, :, 0] = block + ord("0")
+            keep[:, :, 0] = (block != NO_ANSWER)
+        else:
+            block = block.astype(np.int16)
+            for i in range(n_digits):
+                power = 10 ** (n_digits - 1 - i)
+                chars[:, :, i] = block // power % 10 + ord("0")
+                keep[:, :, i] = (block >= power) if i < n_digits - 1 else (block != NO_ANSWER)
+        chars[:, :, -1] = ord(",")
+        chars[:, -1, -1] = ord("\n")
+        out_f.write(chars[keep].tobytes().decode("ascii"))
+
+######################################################################
+######################################################################
+
+NPY_HEADER_SIZE = 128 # fixed so the header can be rewritten as rows are added
+
+ARRAY_DESCRIPTIONS = {
+    "a": "answer index given by each student to each question (0 = A, 1 = B, etc, %d = blank)" % NO_ANSWER,
+    "section": "Section field of the Scantron of each student",
+    "n_s_qa": "number of responses per question per answer",
+    "n_s_q": "number of responses per question",
+    "n_na_q": "number of non-responses per question",
+    "p_q": "average response per question (1 = A, 5 = E)",
+    "r_s_qa": "fraction of responses per question per answer",
+    "r_na_q": "fraction of non-responses per question",
+    "p_q_lo": "lower end of the bootstrap interval for p_q",
+    "p_q_hi": "upper end of the bootstrap interval for p_q",
+    "r_s_qa_lo": "lower end of the bootstrap interval for r_s_qa",
+    "r_s_qa_hi": "upper end of the bootstrap interval for r_s_qa",
+    "pearson_qq": "Pearson correlation between the answers to each pair of questions, from the students who answered both (NaN if undefined)",
+    "spearman_qq": "Spearman rank correlation between the answers to each pair of questions, from the students who answered both (NaN if undefined)",
+}
+
+def write_npy_header(out_f, dtype, shape):
+    """write_npy_header(out_f, dtype, shape)
+
+    Write a .npy header that is always NPY_HEADER_SIZE bytes long.
+    """
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" \
+        % (np.lib.format.dtype_to_descr(np.dtype(dtype)), tuple(shape))
+    header = header.ljust(NPY_HEADER_SIZE - 11) + "\n"
+    out_f.write(b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1"))
+
+def open_npy_rows(filename, dtype, row_shape, n_rows=0):
+    """out_f = open_npy_rows(filename, dtype, row_shape, n_rows=0)
+
+    Open a .npy file to add rows to, keeping only the first n_rows
+    rows already in the file. The header must be updated with
+    close_npy_rows() once all rows have been written.
+    """
+    if n_rows == 0:
+        out_f = open(filename, "wb")
+        write_npy_header(out_f, dtype, (0,) + tuple(row_shape))
+        return out_f
+    out_f = open(filename, "r+b")
+    out_f.truncate(NPY_HEADER_SIZE + n_rows * npy_row_bytes(dtype, row_shape))
+    out_f.seek(0, os.SEEK_END)
+    return out_f
+
+def close_npy_rows(out_f, dtype, row_shape, n_rows):
+    """close_npy_rows(out_f, dtype, row_shape, n_rows)
+
+    Write the final header with n_rows rows and close the file.
+    """
+    out_f.truncate(NPY_HEADER_SIZE + n_rows * npy_row_bytes(dtype, row_shape))
+    out_f.seek(0)
+    write_npy_header(out_f, dtype, (n_rows,) + tuple(row_shape))
+    out_f.close()
+
+def npy_row_bytes(dtype, row_shape):
+    return np.dtype(dtype).itemsize * int(np.prod(row_shape))
+
+def npy_rows_exist(filename, dtype, row_shape, n_rows):
+    """Whether the .npy file from open_npy_rows() has at least n_rows rows."""
+    return os.path.isfile(filename) \
+        and os.path.getsize(filename) >= NPY_HEADER_SIZE + n_rows * npy_row_bytes(dtype, row_shape)
+
+def write_binary_answers(output_dir, a, section):
+    """write_binary_answers(output_dir, a, section)
+
+    Write the answer matrix and sections as a.npy and section.npy in
+    the output directory.
+    """
+    log_and_print("Writing binary answers: %s" % output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    np.save(os.path.join(output_dir, "a.npy"), a)
+    np.save(os.path.join(output_dir, "section.npy"), section)
+    count_bytes_written(os.path.join(output_dir, "a.npy"), os.path.join(output_dir, "section.npy"))
+
+def read_binary_answers(input_dir):
+    """(a, section) = read_binary_answers(input_dir)
+
+    Memory map the a.npy and section.npy files written by
+    write_binary_answers(), stream_scantrons() or ingest_scantrons().
+    """
+    log_and_print("Reading binary answers: %s" % input_dir)
+    a = np.load(os.path.join(input_dir, "a.npy"), mmap_mode="r")
+    section = np.load(os.path.join(input_dir, "section.npy"), mmap_mode="r")
+    return (a, section)
+
+def write_binary_statistics(output_dir, library, d):
+    """write_binary_statistics(output_dir, library, d)
+
+    Write every statistics array in d as a .npy file in the output
+    directory, together with a manifest.json file that describes all
+    the arrays (including a.npy and section.npy) and the questions.
+    The arrays can be loaded with np.load(filename, mmap_mode="r").
+    Any other .npy files in the output directory are removed.
+    """
+    log_and_print("Writing binary statistics: %s" % output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    arrays = {}
+    for name in ["a", "section"]:
+        filename = os.path.join(output_dir, name + ".npy")
+        if os.path.isfile(filename):
+            arr = np.load(filename, mmap_mode="r")
+            arrays[name] = (arr.shape, arr.dtype)
+    for (name, value) in sorted(vars(d).items()):
+        if not isinstance(value, np.ndarray) or name in ["a", "section"]:
+            continue
+        np.save(os.path.join(output_dir, name + ".npy"), value)
+        count_bytes_written(os.path.join(output_dir, name + ".npy"))
+        arrays[name] = (value.shape, value.dtype)
+    manifest = {
+        "version": VERSION,
+        "N_s": int(d.N_s),
+        "N_q": int(d.N_q),
+        "N_a": int(d.N_a),
+        "no_answer": NO_ANSWER,
+        "title_block": library.title_block,
+        "zones": [],
+        "arrays": {},
+    }
+    qi = 0
+    for zone in library.zones:
+        questions = []
+        for question in zone.questions:
+            questions.append({"number": qi + 1, "body": question.body,
+                              "left_choice": question.left_choice,
+                              "right_choice": question.right_choice})
+            qi += 1
+        manifest["zones"].append({"title": zone.title, "questions": questions})
+    for (name, (shape, dtype)) in sorted(arrays.items()):
+        manifest["arrays"][name] = {"file": name + ".npy", "shape": list(shape), "dtype": str(dtype),
+                                    "description": ARRAY_DESCRIPTIONS.get(name, "")}
+    with open(os.path.join(output_dir, "manifest.json"), "w") as out_f:
+        json.dump(manifest, out_f, indent=2)
+        out_f.write("\n")
+    count_bytes_written(os.path.join(output_dir, "manifest.json"))
+    for filename in sorted(os.listdir(output_dir)):
+        (name, ext) = os.path.splitext(filename)
+        if ext == ".npy" and name not in arrays:
+            # left by an earlier run with other options, like --bootstrap
+            log("Removing array that is not in the manifest: %s", os.path.join(output_dir, filename))
+            os.remove(os.path.join(output_dir, filename))
+    log("Successfully completed writing binary statistics")
+
+######################################################################
+######################################################################
+
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    course TEXT NOT NULL,
+    term TEXT NOT NULL,
+    filters TEXT NOT NULL,
+    N_s INTEGER NOT NULL,
+    version TEXT NOT NULL,
+    created TEXT NOT NULL,
+    UNIQUE (course, term, filters)
+);
+CREATE TABLE IF NOT EXISTS questions (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    q INTEGER NOT NULL,
+    zone TEXT NOT NULL,
+    body TEXT NOT NULL,
+    left_choice TEXT NOT NULL,
+    right_choice TEXT NOT NULL,
+    n_s INTEGER NOT NULL,
+    n_na INTEGER NOT NULL,
+    p REAL,
+    p_lo REAL,
+    p_hi REAL,
+    r_na REAL,
+    PRIMARY KEY (run_id, q)
+);
+CREATE TABLE IF NOT EXISTS answers (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    q INTEGER NOT NULL,
+    answer TEXT NOT NULL,
+    n_s INTEGER NOT NULL,
+    r_s REAL,
+    r_s_lo REAL,
+    r_s_hi REAL,
+    PRIMARY KEY (run_id, q, answer)
+);
+CREATE INDEX IF NOT EXISTS questions_zone ON questions (zone);
+"""
+
+# full text index of the question text, with trigrams so that any
+# substring of three or more characters is found through the index
+# (the trigram tokenizer needs SQLite 3.34 or later)
+STORE_TEXT_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS questions_text USING fts5 (body, run_id UNINDEXED, q UNINDEXED,
+                                                              tokenize = 'trigram')
+"""
+
+# user_version of a store whose questions were written without the
+# questions_text index, so it must be rebuilt before it is used
+STORE_TEXT_STALE = 1
+
+def split_prefix(prefix):
+    """(course, term) = split_prefix(prefix)
+
+    Split a filename prefix like "tam212_sp18_" into the course
+    "tam212" and the term "sp18". If there is no term then it is "".
+    """
+    name = os.path.basename(prefix).strip("_")
+    if "_" not in name:
+        return (name, "")
+    return tuple(name.rsplit("_", 1))
+
+def term_sort_key(term):
+    """key = term_sort_key(term)
+
+    Sort key that puts terms like "fa17", "sp18", "su18", "fa18" in
+    time order, and any other terms after them by name.
+    """
+    match = re.match(r"^([a-z]+)(\d+)$", term.lower())
+    seasons = ["wi", "sp", "su", "fa"]
+    if match is None or match.group(1) not in seasons:
+        return (1, 0, 0, term)
+    return (0, int(match.group(2)), seasons.index(match.group(1)), term)
+
+def open_store(db_filename):
+    """(db, text_index) = open_store(db_filename)
+
+    Open the SQLite results store, creating the tables and indexes if
+    they don't exist yet. text_index is whether the questions_text
+    index can be used. If this SQLite has no trigram tokenizer then the
+    store is used without it, and the index is rebuilt the next time
+    the store is opened with an SQLite that has one.
+    """
+    db = sqlite3.connect(db_filename, timeout=60)
+    db.executescript(STORE_SCHEMA)
+    try:
+        with db:
+            db.execute(STORE_TEXT_SCHEMA)
+            db.execute("SELECT 1 FROM questions_text LIMIT 1").fetchall()
+            if db.execute("PRAGMA user_version").fetchone()[0] == STORE_TEXT_STALE:
+                db.execute("DELETE FROM questions_text")
+                db.execute("INSERT INTO questions_text (body, run_id, q) SELECT body, run_id, q FROM questions")
+                db.execute("PRAGMA user_version = 0")
+    except sqlite3.OperationalError:
+        return (db, False)
+    return (db, True)
+
+def store_results(db_filename, course, term, filters, library, d):
+    """store_results(db_filename, course, term, filters, library, d)
+
+    Add the questions and statistics in d to the SQLite results store,
+    replacing any earlier results for the same course, term and
+    filters (like "q1A", or "" for no filters).
+    """
+    log_and_print("Storing results for course '%s' term '%s' in: %s" % (course, term, db_filename))
+    def optional(name):
+        return getattr(d, name).tolist() if hasattr(d, name) else [None] * d.N_q
+    (p_lo, p_hi) = (optional("p_q_lo"), optional("p_q_hi"))
+    r_s_lo = d.r_s_qa_lo.tolist() if hasattr(d, "r_s_qa_lo") else [[None] * d.N_a] * d.N_q
+    r_s_hi = d.r_s_qa_hi.tolist() if hasattr(d, "r_s_qa_hi") else [[None] * d.N_a] * d.N_q
+    (n_s_q, n_na_q, p_q, r_na_q) = (d.n_s_q.tolist(), d.n_na_q.tolist(), d.p_q.tolist(), d.r_na_q.tolist())
+    (n_s_qa, r_s_qa) = (d.n_s_qa.tolist(), d.r_s_qa.tolist())
+    nan_to_null = lambda x: None if x != x else x
+    (db, text_index) = open_store(db_filename)
+    if not text_index:
+        log_and_print("WARNING: SQLite %s has no FTS5 trigram tokenizer, so the question text is stored without"
+                      " the questions_text index" % sqlite3.sqlite_version, level=LOG_WARNING)
+    with db:
+        for table in ["answers", "questions"] + (["questions_text"] if text_index else []):
+            db.execute("DELETE FROM %s WHERE run_id IN (SELECT run_id FROM runs WHERE course = ? AND term = ? AND filters = ?)"
+                       % table, (course, term, filters))
+        db.execute("DELETE FROM runs WHERE course = ? AND term = ? AND filters = ?", (course, term, filters))
+        run_id = db.execute("INSERT INTO runs (course, term, filters, N_s, version, created) VALUES (?, ?, ?, ?, ?, ?)",
+                            (course, term, filters, int(d.N_s), VERSION,
+                             datetime.datetime.now().isoformat(timespec="seconds"))).lastrowid
+        question_rows = []
+        answer_rows = []
         qi = 0
         for zone in library.zones:
             for question in zone.questions:
-                if qi > 0:
-                    out_f.write(",")
-                out_f.write('"%d. %s"' % (qi + 1, question.body))
+                question_rows.append((run_id, qi + 1, zone.title, question.body, question.left_choice,
+                                      question.right_choice, n_s_q[qi], n_na_q[qi], nan_to_null(p_q[qi]),
+                                      nan_to_null(p_lo[qi]), nan_to_null(p_hi[qi]), nan_to_null(r_na_q[qi])))
+                for ai in range(d.N_a):
+                    answer_rows.append((run_id, qi + 1, ind2chr(ai), n_s_qa[qi][ai], nan_to_null(r_s_qa[qi][ai]),
+                                        r_s_lo[qi][ai], r_s_hi[qi][ai]))
                 qi += 1
-        out_f.write('\n')
-        
-        for si in range(N_s):
-            for qi in range(N_q):
-                if qi > 0:
-                    out_f.write(",")
-                ai = chr2ind(a[si,qi])
-                if ai >= 0:
-                    out_f.write("%d" % ai)
-            out_f.write('\n')
-    log("Successfully completed writing answers CSV file")
+        db.executemany("INSERT INTO questions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", question_rows)
+        db.executemany("INSERT INTO answers VALUES (?, ?, ?, ?, ?, ?, ?)", answer_rows)
+        if text_index:
+            db.executemany("INSERT INTO questions_text (body, run_id, q) VALUES (?, ?, ?)",
+                           [(row[3], row[0], row[1]) for row in question_rows])
+        else:
+            db.execute("PRAGMA user_version = %d" % STORE_TEXT_STALE)
+    db.close()
+    log("Successfully completed storing results")
+
+def query_store(db_filename, text, course=None):
+    """query_store(db_filename, text, course=None)
+
+    Print CSV results from the SQLite results store for every question
+    whose text contains 'text', for every course (or only the given
+    course) and term, in time order, so the same question can be
+    compared across terms and courses.
+    """
+    (db, text_index) = open_store(db_filename)
+    if text_index and len(text) >= 3:
+        # a quoted phrase matches any substring through the trigram index
+        (source, where, pattern) = ("""questions_text
+                                       JOIN questions ON questions.run_id = questions_text.run_id
+                                                     AND questions.q = questions_text.q""",
+                                    "questions_text MATCH ?", '"' + text.replace('"', '""') + '"')
+    else:
+        # too short for a trigram (or no trigram index), so every question is scanned
+        (source, where, pattern) = ("questions", "questions.body LIKE ? ESCAPE '\\'",
+                                    "%" + text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+    rows = {}
+    answers = {}
+    for row in db.execute("""SELECT questions.run_id, questions.body, runs.course, runs.term, runs.filters,
+                                    questions.q, questions.zone, runs.N_s, questions.n_s, questions.p,
+                                    questions.p_lo, questions.p_hi, answers.r_s
+                             FROM %s
+                             JOIN runs ON runs.run_id = questions.run_id
+                             JOIN answers ON answers.run_id = questions.run_id AND answers.q = questions.q
+                             WHERE %s AND (? IS NULL OR runs.course = ?)
+                             ORDER BY answers.run_id, answers.q, answers.answer""" % (source, where),
+                          (pattern, course, course)):
+        rows[(row[0], row[5])] = row[:-1]
+        answers.setdefault((row[0], row[5]), []).append(row[-1])
+    db.close()
+    rows = sorted(rows.values(), key=lambda row: (row[1], row[2], row[4], term_sort_key(row[3])))
+    N_a = max([len(r_s) for r_s in answers.values()] + [0])
+    writer = csv.writer(sys.stdout)
+    writer.writerow(["question", "course", "term", "filters", "q", "zone", "N_s", "n_s(q)", "p(q)",
+                     "p_lo(q)", "p_hi(q)"] + ["r_s(q,a=%s)" % ind2chr(ai) for ai in range(N_a)])
+    for row in rows:
+        writer.writerow(["" if x is None else x for x in row[1:] + tuple(answers[(row[0], row[5])])])
 
 ######################################################################
 ######################################################################
@@ -424,93 +2605,727 @@ def write_csv(output_filename, headers, data, index_formats=None):
     log_and_print("Writing statistics file: %s" % output_filename)
     if index_formats == None:
         index_formats = ["i"] * len(data.shape)
-    def format_index(i, f):
+    def format_indexes(n, f):
         if f == "i":
-            return i + 1
+            return [str(i + 1) for i in range(n)]
         elif f == "c":
-            return ind2chr(i)
+            return [ind2chr(i) for i in range(n)]
     with open(output_filename, "w") as out_f:
         writer = csv.writer(out_f)
         if len(data.shape) == 0:
             writer.writerow(headers[0])
             writer.writerow([data])
-        elif len(data.shape) == 1:
-            assert(len(headers) == 2)
-            writer.writerow(headers)
-            for i in range(data.shape[0]):
-                writer.writerow([format_index(i, index_formats[0]), data[i]])
         else:
-            row = headers[:-1]
-            for j in range(data.shape[-1]):
-                row.append(headers[-1] % format_index(j, index_formats[-1]))
-            writer.writerow(row)
-            for index in np.ndindex(data.shape[:-1]):
-                row = [format_index(index[i], index_formats[i])
-                           for i in range(len(index))]
-                for j in range(data.shape[-1]):
-                    row.append(data[index + (j,)])
-                writer.writerow(row)
+            if len(data.shape) == 1:
+                assert(len(headers) == 2)
+                writer.writerow(headers)
+                # written as a column, so each value is a row of its own
+                data = data.reshape(-1, 1)
+            else:
+                writer.writerow(headers[:-1] + [headers[-1] % j for j
+                                                in format_indexes(data.shape[-1], index_formats[-1])])
+            out_f.write(format_csv_rows(data, [format_indexes(n, index_formats[i])
+                                               for (i, n) in enumerate(data.shape[:-1])],
+                                        writer.dialect.lineterminator))
+    count_bytes_written(output_filename)
     log("Successfully completed writing statistics file")
 
-def generate_statistics(output_prefix, a, N_a):
-    """d = generate_statistics(output_prefix, a, N_a)
+def format_csv_rows(data, index_labels, lineterminator):
+    """text = format_csv_rows(data, index_labels, lineterminator)
 
-    d is a structure containing all data arrays and all generated
-    statistics arrays.
+    Format all the rows of an nD array for write_csv() in one go, with
+    the first n - 1 indexes (written with the labels in index_labels)
+    starting each row and the values along the last index after them.
+    The values are formatted with str(), as csv.writer does.
+    """
+    rows = [",".join(map(str, row)) for row in data.reshape(-1, data.shape[-1]).tolist()]
+    for i in reversed(range(len(index_labels))):
+        repeat = int(np.prod(data.shape[i + 1:-1]))
+        labels = itertools.cycle([label for label in index_labels[i] for r in range(repeat)])
+        rows = [label + "," + row for (label, row) in zip(labels, rows)]
+    return "".join(row + lineterminator for row in rows)
 
-    Statistics arrays are output to individual files with the given
-    output_prefix.
+def count_answers(a, N_a):
+    """n_s_qa = count_answers(a, N_a)
+
+    Count the answers in a single bincount over the answer matrix.
+
+    n_s_qa[q,a] = number of students giving answer a to question q
+
+    Blank answers (NO_ANSWER) and answers past the last allowed answer
+    (digits above N_a on the Scantron) are not counted.
     """
-    log_and_print("Generating statistics")
-    d = Struct()
+    (N_s, N_q) = a.shape
+    valid = (a >= 0) & (a < N_a)
+    qa_index = np.arange(N_q) * N_a + a.astype(np.intp)
+    n_s_qa = np.bincount(qa_index[valid], minlength=N_q * N_a)
+    return n_s_qa.reshape(N_q, N_a)
 
-    (d.N_s, d.N_q) = a.shape
-    d.N_a = N_a
+def compute_statistics(n_s_qa, N_s):
+    """d = compute_statistics(n_s_qa, N_s)
 
-    d.a = a
+    Compute all statistics arrays from the answer counts n_s_qa over
+    N_s students.
+    """
+    d = Struct()
+
+    (d.N_q, d.N_a) = n_s_qa.shape
+    d.N_s = N_s
 
     # number of responses per question per answer
-    d.n_s_qa = np.zeros((d.N_q, d.N_a), dtype=int)
-    for si in range(d.N_s):
-        for qi in range(d.N_q):
-            ai = chr2ind(d.a[si,qi])
-            if ai >= 0:
-                d.n_s_qa[qi,ai] += 1
-    write_csv(output_prefix + "_n_s_qa.csv", ["q", "n_s(q,a=%s)"], d.n_s_qa,
-              index_formats=['i', 'c'])
+    d.n_s_qa = n_s_qa
 
     # number of responses per question
     d.n_s_q = d.n_s_qa.sum(axis=1)
-    write_csv(output_prefix + "_n_s_q.csv", ["q", "n_s(q)"], d.n_s_q)
 
     # number of non-responses per question
     d.n_na_q = d.N_s - d.n_s_q
-    write_csv(output_prefix + "_n_na_q.csv", ["q", "n_na(q)"], d.n_na_q)
 
-    # average response per question (1 = A, 5 = E)
-    d.p_q = np.zeros(d.N_q, dtype=float)
-    for qi in range(d.N_q):
-        for ai in range(d.N_a):
-            d.p_q += (ai + 1) * float(d.n_s_qa[qi,ai]) / d.n_s_q[qi]
-    write_csv(output_prefix + "_p_q.csv", ["q", "p(q)"], d.p_q)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # average response per question (1 = A, 5 = E)
+        d.p_q = ((np.arange(d.N_a) + 1) * d.n_s_qa.astype(float)
+                 / d.n_s_q[:, None]).sum(axis=1)
 
-    # fraction of responses per question per answer
-    d.r_s_qa = np.zeros((d.N_q, d.N_a), dtype=float)
-    for qi in range(d.N_q):
-        for ai in range(d.N_a):
-            d.r_s_qa[qi,ai] = float(d.n_s_qa[qi,ai]) / d.N_s
+        # fraction of responses per question per answer
+        d.r_s_qa = d.n_s_qa.astype(float) / d.N_s
+
+        # fraction of non-responses per question
+        d.r_na_q = d.n_na_q.astype(float) / d.N_s
+
+    return d
+
+def generate_statistics(output_prefix, a, N_a, n_boot=0, seed=0, correlations=False):
+    """d = generate_statistics(output_prefix, a, N_a, n_boot=0, seed=0, correlations=False)
+
+    d is a structure containing all data arrays and all generated
+    statistics arrays.
+
+    Statistics arrays are output to individual files with the given
+    output_prefix. If n_boot > 0 then bootstrap confidence intervals
+    are also generated with generate_bootstrap_intervals(), and if
+    correlations is True then the correlations between questions are
+    generated with generate_correlations().
+    """
+    d = generate_statistics_from_counts(output_prefix, count_answers(a, N_a), a.shape[0])
+    d.a = a
+    if n_boot > 0:
+        generate_bootstrap_intervals(output_prefix, d, a, n_boot, seed)
+    if correlations:
+        generate_correlations(output_prefix, d, a)
+    return d
+
+def generate_statistics_from_counts(output_prefix, n_s_qa, N_s):
+    """d = generate_statistics_from_counts(output_prefix, n_s_qa, N_s)
+
+    As for generate_statistics(), but starting from the answer counts
+    n_s_qa over N_s students, without the answer matrix.
+    """
+    log_and_print("Generating statistics")
+    d = compute_statistics(n_s_qa, N_s)
+    write_statistics_csvs(output_prefix, d)
+    log("Successfully completed generating statistics")
+    return d
+
+def write_statistics_csvs(output_prefix, d):
+    """write_statistics_csvs(output_prefix, d)
+
+    Write each statistics array in d to its own CSV file with the
+    given output_prefix.
+    """
+    write_csv(output_prefix + "_n_s_qa.csv", ["q", "n_s(q,a=%s)"], d.n_s_qa,
+              index_formats=['i', 'c'])
+    write_csv(output_prefix + "_n_s_q.csv", ["q", "n_s(q)"], d.n_s_q)
+    write_csv(output_prefix + "_n_na_q.csv", ["q", "n_na(q)"], d.n_na_q)
+    write_csv(output_prefix + "_p_q.csv", ["q", "p(q)"], d.p_q)
     write_csv(output_prefix + "_r_s_qa.csv", ["q", "r_s(q,a=%s)"], d.r_s_qa,
               index_formats=['i', 'c'])
-
-    # fraction of non-responses per question
-    d.r_na_q = np.zeros(d.N_q, dtype=float)
-    for qi in range(d.N_q):
-        d.r_na_q[qi] = float(d.n_na_q[qi]) / d.N_s
     write_csv(output_prefix + "_r_na_q.csv", ["q", "r_na(q)"], d.r_na_q)
 
+def bootstrap_counts(a, N_a, n_boot, seed=0, chunk_size=2**22):
+    """n_b_qa = bootstrap_counts(a, N_a, n_boot, seed=0, chunk_size=2**22)
+
+    Count the answers in n_boot bootstrap replicates, each resampling
+    the students in a with replacement.
+
+    n_b_qa[b,q,a] = number of students giving answer a to question q in
+                    bootstrap replicate b
+
+    Each block of replicates draws the resampled student indexes with
+    a seeded RNG and turns them into weights (the number of times each
+    student was drawn), so the counts for the whole block are the
+    product of the weights with the one-hot answer matrix. Blocks of
+    replicates and students are chosen so that about chunk_size
+    weights or one-hot entries are in memory at once. The replicates
+    only depend on the seed, not on the chunk size.
+    """
+    (N_s, N_q) = a.shape
+    rng = np.random.default_rng(seed)
+    n_b_qa = np.zeros((n_boot, N_q * N_a), dtype=np.int64)
+    boot_block = max(1, chunk_size // max(N_s, 1))
+    student_block = max(1, chunk_size // max(N_q * N_a, 1))
+    for b in range(0, n_boot, boot_block):
+        n_b = min(boot_block, n_boot - b)
+        index = rng.integers(0, N_s, size=(n_b, N_s))
+        weights = np.bincount((np.arange(n_b)[:, None] * N_s + index).ravel(), minlength=n_b * N_s)
+        weights = weights.reshape(n_b, N_s).astype(np.float64)
+        for i in range(0, N_s, student_block):
+            one_hot = (a[i:i + student_block, :, None] == np.arange(N_a)).reshape(-1, N_q * N_a)
+            n_b_qa[b:b + n_b] += np.rint(weights[:, i:i + student_block] @ one_hot).astype(np.int64)
+    return n_b_qa.reshape(n_boot, N_q, N_a)
+
+def generate_bootstrap_intervals(output_prefix, d, a, n_boot, seed=0):
+    """generate_bootstrap_intervals(output_prefix, d, a, n_boot, seed=0)
+
+    Add percentile bootstrap confidence intervals (at the
+    BOOTSTRAP_CONFIDENCE level) for p_q and r_s_qa to d, from n_boot
+    replicates of the answer matrix a, and write them to CSV files
+    with the given output_prefix.
+
+    p_q_lo[q], p_q_hi[q] = interval for the average response p_q[q]
+    r_s_qa_lo[q,a], r_s_qa_hi[q,a] = interval for r_s_qa[q,a]
+    """
+    log_and_print("Generating bootstrap intervals from %d replicates" % n_boot)
+    compute_bootstrap_intervals(d, a, n_boot, seed)
+    write_csv(output_prefix + "_p_q_lo.csv", ["q", "p_lo(q)"], d.p_q_lo)
+    write_csv(output_prefix + "_p_q_hi.csv", ["q", "p_hi(q)"], d.p_q_hi)
+    write_csv(output_prefix + "_r_s_qa_lo.csv", ["q", "r_s_lo(q,a=%s)"], d.r_s_qa_lo,
+              index_formats=['i', 'c'])
+    write_csv(output_prefix + "_r_s_qa_hi.csv", ["q", "r_s_hi(q,a=%s)"], d.r_s_qa_hi,
+              index_formats=['i', 'c'])
+    log("Successfully completed generating bootstrap intervals")
+
+def compute_bootstrap_intervals(d, a, n_boot, seed=0):
+    """compute_bootstrap_intervals(d, a, n_boot, seed=0)
+
+    As for generate_bootstrap_intervals(), but without writing any
+    files.
+    """
+    n_b_qa = bootstrap_counts(a, d.N_a, n_boot, seed)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p_b_q = ((np.arange(d.N_a) + 1) * n_b_qa / n_b_qa.sum(axis=2)[:, :, None]).sum(axis=2)
+        r_b_qa = n_b_qa / float(d.N_s)
+    percentiles = [50 * (1 - BOOTSTRAP_CONFIDENCE), 50 * (1 + BOOTSTRAP_CONFIDENCE)]
+    with warnings.catch_warnings():
+        # questions with no responses have no average
+        warnings.simplefilter("ignore", RuntimeWarning)
+        (d.p_q_lo, d.p_q_hi) = np.nanpercentile(p_b_q, percentiles, axis=0)
+    (d.r_s_qa_lo, d.r_s_qa_hi) = np.percentile(r_b_qa, percentiles, axis=0)
+    log_array(d.p_q_lo, "p_q_lo", ["N_q"])
+    log_array(d.p_q_hi, "p_q_hi", ["N_q"])
+
+######################################################################
+######################################################################
+# In-memory API
+
+class SurveyProcessor:
+    """processor = SurveyProcessor(library_text, log_level=LOG_INFO, verbose=False, layout_text=None)
+
+    Process surveys in memory, without reading or writing any files,
+    for use from a long-running program. The library text (and the
+    scanner layout JSON text, if it is not SCANTRON_LAYOUT) is parsed
+    once and then process() can be called for any number of Scantron
+    files, for example:
+
+        processor = SurveyProcessor(open("library.tex").read())
+        result = processor.process(scantron_bytes, filters=[(1, 0)])
+        print(result.d.p_q)
+
+    Errors raise SurveyError. Logging uses module globals, so a
+    SurveyProcessor must only be used by one thread at a time.
+    """
+    def __init__(self, library_text, log_level=LOG_INFO, verbose=False, layout_text=None):
+        self.log_level = log_level
+        self.verbose = verbose
+        (self.library, self.log, self.output) = self.run(parse_library, "<library>",
+                                                         io.StringIO(library_text, newline=None))
+        if layout_text is None:
+            self.layout = read_layout(None)
+        else:
+            self.layout = self.run(parse_layout, "<layout>", layout_text)[0]
+        self.N_q = sum([len(zone.questions) for zone in self.library.zones])
+
+    def process(self, scantrons, filters=[], n_boot=0, seed=0, correlations=False):
+        """result = processor.process(scantrons, filters=[], n_boot=0, seed=0, correlations=False)
+
+        Process the Scantron data, given as bytes or a binary stream,
+        with the filters, bootstrap and correlations options as for
+        survey_options(). The result has:
+
+        result.library = the parsed library
+        result.a[s,q] = index of the answer given by student s to
+                        question q (0 = A, 1 = B, etc), or NO_ANSWER
+        result.section[s] = Section field of the Scantron of student s
+        result.d = statistics structure, as from generate_statistics()
+        result.problems = problems found in the Scantrons, as from
+                          init_problems()
+        result.quarantine = the Scantron lines with problems, which
+                            are left out of a
+        result.log = the log messages
+        result.output = the messages that would be printed
+        """
+        if isinstance(scantrons, (bytes, bytearray, memoryview)):
+            scantrons = io.BytesIO(scantrons)
+        problems = init_problems(quarantine_f=io.BytesIO())
+        (d, log_text, output) = self.run(self.compute, scantrons, problems, filters, n_boot, seed, correlations)
+        return Struct(library=self.library, a=d.a, section=d.section, d=d, problems=problems,
+                      quarantine=problems.quarantine_f.getvalue(), log=log_text, output=output)
+
+    def compute(self, scantrons, problems, filters, n_boot, seed, correlations):
+        # the filters are checked here, so that they fail with a
+        # SurveyError rather than the Exception from filter_scantrons()
+        for (filter_q, filter_a) in filters:
+            if filter_q < 1 or filter_q > self.N_q:
+                die("ERROR: filter question %d out of range (must be between 1 and %d)" % (filter_q, self.N_q))
+        (a, section) = read_scantrons("<scantron>", self.N_q, problems, in_f=scantrons, layout=self.layout)
+        if len(filters) > 0:
+            if not filter_mask(a, filters).any():
+                die("ERROR: after filtering no Scantrons were left")
+            (a, section) = filter_scantrons(a, section, filters)
+        d = compute_statistics(count_answers(a, N_a), a.shape[0])
+        d.a = a
+        d.section = section
+        if n_boot > 0:
+            compute_bootstrap_intervals(d, a, n_boot, seed)
+        if correlations:
+            (d.pearson_qq, d.spearman_qq) = compute_correlations(count_cooccurrence(a, N_a))
+        return d
+
+    def run(self, func, *args):
+        """(value, log_text, output) = processor.run(func, *args)
+
+        Call func(*args) with logging and printed messages captured as
+        strings, turning a call to die() into a SurveyError.
+        """
+        log_f = io.StringIO()
+        output = io.StringIO()
+        with logging_to(log_f, self.log_level, self.verbose), contextlib.redirect_stdout(output):
+            try:
+                value = func(*args)
+            except SystemExit:
+                raise SurveyError(output.getvalue().rstrip("\n").split("\n")[-1])
+        return (value, log_f.getvalue(), output.getvalue())
+
+class SurveyError(Exception):
+    """An error from die() while processing a survey with SurveyProcessor.
+    """
+    pass
+
+######################################################################
+######################################################################
+
+def generate_library(output_filename, N_q, zone_size=10):
+    """generate_library(output_filename, N_q, zone_size=10)
+
+    Write a synthetic library file with N_q questions in zones of
+    zone_size questions.
+    """
+    with open(output_filename, "w") as out_f:
+        out_f.write(r"\documentclass{article}" + "\n")
+        out_f.write(r"\begin{document}" + "\n")
+        out_f.write(r"\begin{center}\Large \bf Synthetic Survey\end{center}" + "\n")
+        for qi in range(N_q):
+            if qi % zone_size == 0:
+                if qi > 0:
+                    out_f.write(r"\end{zone}" + "\n")
+                out_f.write("\n" + r"\begin{zone}{Zone %d}" % (qi // zone_size + 1) + "\n")
+            out_f.write(r"\question{Synthetic question %d}{Strongly Agree}{Strongly Disagree}" % (qi + 1) + "\n")
+        if N_q > 0:
+            out_f.write(r"\end{zone}" + "\n")
+        out_f.write(r"\end{document}" + "\n")
+
+def generate_scantrons(output_filename, N_s, N_q, seed=0, bad_fraction=0.0, short_fraction=0.0,
+                       chunk_size=100000, layout=None):
+    """generate_scantrons(output_filename, N_s, N_q, seed=0, bad_fraction=0.0, short_fraction=0.0,
+                          chunk_size=100000, layout=None)
+
+    Write a synthetic Scantron file of N_s fixed-width lines in the
+    scanner layout from compile_layout() (or SCANTRON_LAYOUT if layout
+    is None), each with a Section field of digits and answers A to E
+    (or blank) in the Answers field, ending with "\r\n", followed by
+    the last line with the terminator character (if any). Columns
+    before the first field are letters and the others are digits.
+
+    A fraction bad_fraction of the lines have an invalid character in
+    one of the first N_q answers, and a fraction short_fraction of the
+    lines are cut short. Lines are made chunk_size at a time as byte
+    matrices, so any number of lines can be written.
+    """
+    print("Writing synthetic Scantron file with %d Scantrons: %s" % (N_s, output_filename))
+    if layout is None:
+        layout = read_layout(None)
+    rng = np.random.default_rng(seed)
+    line_end = layout.line_end
+    (section, answers) = (layout.section, layout.answers)
+    id_chars = np.frombuffer(string.ascii_uppercase.encode("ascii") + b" ", dtype=np.uint8)
+    digits = np.frombuffer(b"0123456789", dtype=np.uint8)
+    # the character of each of the answers A to E, and a blank
+    answer_char = {}
+    for (c, i) in sorted(layout.answer_chars.items()):
+        answer_char.setdefault(i, c)
+    chars = [answer_char[ai] for ai in range(N_a) if ai in answer_char]
+    blanks = [c for c in answers.alphabet if c not in layout.answer_chars]
+    if len(chars) < N_a or len(blanks) == 0:
+        die("ERROR: scanner layout %s must have characters for answers A to %s and a blank"
+            % (layout.name, ind2chr(N_a - 1)))
+    blank = " " if " " in blanks else blanks[0]
+    answer_chars = np.frombuffer(("".join(chars) + blank).encode("ascii"), dtype=np.uint8)
+    bad_chars = np.frombuffer("".join(c for c in "x*?" if c not in answers.alphabet).encode("ascii"), dtype=np.uint8)
+    other = np.ones(line_end, dtype=bool)
+    for field in [section, answers]:
+        other[field.offset:field.offset + field.width] = False
+    id_cols = np.flatnonzero(other[:min(section.offset, answers.offset)])
+    digit_cols = np.flatnonzero(other)[len(id_cols):]
+    with open(output_filename, "wb") as out_f:
+        for start in range(0, N_s, chunk_size):
+            n = min(chunk_size, N_s - start)
+            records = np.empty((n, line_end + 2), dtype=np.uint8)
+            records[:, id_cols] = id_chars[rng.integers(0, len(id_chars), size=(n, len(id_cols)))]
+            section_number = rng.integers(1, 21, size=n)
+            for i in range(section.width):
+                records[:, section.offset + i] = digits[section_number // 10 ** (section.width - 1 - i) % 10]
+            records[:, digit_cols] = digits[rng.integers(0, 10, size=(n, len(digit_cols)))]
+            # blank answers are less common than each of the answers
+            records[:, answers.offset:answers.offset + answers.width] \
+                = answer_chars[rng.choice(len(answer_chars), size=(n, answers.width), p=[0.19] * 5 + [0.05])]
+            records[:, line_end:] = np.frombuffer(b"\r\n", dtype=np.uint8)
+            bad = np.flatnonzero(rng.random(n) < bad_fraction)
+            if len(bad_chars) > 0:
+                records[bad, answers.offset + rng.integers(0, max(N_q, 1), size=len(bad))] \
+                    = bad_chars[rng.integers(0, len(bad_chars), size=len(bad))]
+            lengths = np.full(n, line_end, dtype=np.intp)
+            short = rng.random(n) < short_fraction
+            lengths[short] = rng.integers(min(section.offset + section.width, line_end - 1), line_end,
+                                          size=short.sum())
+            if short.any():
+                keep = np.arange(line_end + 2) < lengths[:, None]
+                keep[:, -2:] = True
+                out_f.write(records[keep].tobytes())
+            else:
+                out_f.write(records.tobytes())
+        if layout.terminator is not None:
+            out_f.write(bytes([layout.terminator]))
+
+def benchmark(N_s, seed=0, baseline_filename=BENCHMARK_BASELINE, save_baseline=False, repeats=3):
+    """ok = benchmark(N_s, seed=0, baseline_filename=BENCHMARK_BASELINE, save_baseline=False, repeats=3)
+
+    Time each stage of processing a synthetic survey of N_s Scantrons,
+    taking the best time of 'repeats' runs, and find its peak memory
+    use with tracemalloc in one more run before them. Tracing slows the
+    stages down by different amounts, so the timed runs are not traced.
+    The results are compared to the baseline file if it is for the same
+    N_s, and saved as the new baseline if save_baseline is True.
+    Returns False if any stage regressed by more than
+    BENCHMARK_TOLERANCE.
+    """
+    N_q = LAST_SCANTRON_QUESTION_NUMBER
+    work_dir = tempfile.mkdtemp(prefix="process_survey_benchmark_")
+    try:
+        f = survey_filenames(os.path.join(work_dir, "bench_"))
+        generate_library(f.library, N_q)
+        generate_scantrons(f.scantron, N_s, N_q, seed, bad_fraction=0.001)
+        print("Running benchmark with %d Scantrons and %d questions, best of %d" % (N_s, N_q, repeats))
+        results = {}
+        traced = False
+        def stage(name, func, *args):
+            if traced:
+                tracemalloc.start()
+                value = func(*args)
+                results[name] = {"seconds": float("inf"), "peak_bytes": tracemalloc.get_traced_memory()[1]}
+                tracemalloc.stop()
+                return value
+            start = time.perf_counter()
+            value = func(*args)
+            results[name]["seconds"] = min(results[name]["seconds"], time.perf_counter() - start)
+            return value
+        # the first run only measures the memory, and warms up the timed runs
+        for i in range(repeats + 1):
+            traced = (i == 0)
+            with contextlib.redirect_stdout(io.StringIO()):
+                init_logging(f.log_proc_report)
+                library = stage("read_library", read_library, f.library)
+                (a, section) = stage("read_scantrons", read_scantrons, f.scantron, N_q)
+                stage("filter_scantrons", filter_scantrons, a, section, [(1, 0)])
+                stage("write_answers", write_answers, f.answers, library, a, N_a)
+                d = stage("generate_statistics", generate_statistics, f.raw_stats_prefix, a, N_a)
+                stage("write_statistics", write_statistics, f.report, library, d)
+                close_logging()
+    finally:
+        shutil.rmtree(work_dir)
+
+    baseline = None
+    if os.path.isfile(baseline_filename):
+        with open(baseline_filename) as in_f:
+            baseline = json.load(in_f)
+        if baseline["N_s"] != N_s:
+            print("Baseline is for %d Scantrons, not comparing: %s" % (baseline["N_s"], baseline_filename))
+            baseline = None
+    ok = True
+    print("%-20s %10s %10s %12s %12s" % ("stage", "seconds", "peak MB", "base seconds", "base peak MB"))
+    for (name, result) in results.items():
+        line = "%-20s %10.3f %10.1f" % (name, result["seconds"], result["peak_bytes"] / 1e6)
+        if baseline is not None and name in baseline["stages"]:
+            base = baseline["stages"][name]
+            line += " %12.3f %12.1f" % (base["seconds"], base["peak_bytes"] / 1e6)
+            # ignore tiny stages, where the noise is bigger than the time
+            if (result["seconds"] > BENCHMARK_TOLERANCE * base["seconds"] and result["seconds"] > 0.01) \
+                    or (result["peak_bytes"] > BENCHMARK_TOLERANCE * base["peak_bytes"]
+                        and result["peak_bytes"] > 1e6):
+                line += "  REGRESSION"
+                ok = False
+        print(line)
+    if save_baseline:
+        with open(baseline_filename, "w") as out_f:
+            json.dump({"version": VERSION, "N_s": N_s, "stages": results}, out_f, indent=2)
+            out_f.write("\n")
+        print("Saved benchmark baseline: %s" % baseline_filename)
+    return ok
+
+######################################################################
+######################################################################
+
+def count_cooccurrence(a, N_a, chunk_size=16384):
+    """n_s_qaqa = count_cooccurrence(a, N_a, chunk_size=16384)
+
+    Count pairs of answers given by the same student.
+
+    n_s_qaqa[q1,a1,q2,a2] = number of students giving answer a1 to
+                            question q1 and answer a2 to question q2
+
+    The counts come from the product of the one-hot answer matrix with
+    itself, taken over chunks of chunk_size students at a time.
+    """
+    (N_s, N_q) = a.shape
+    n_s_qaqa = np.zeros((N_q * N_a, N_q * N_a), dtype=np.int64)
+    for i in range(0, N_s, chunk_size):
+        one_hot = (a[i:i + chunk_size, :, None] == np.arange(N_a)).reshape(-1, N_q * N_a)
+        # float32 counts are exact for chunks of up to 2**24 students
+        one_hot = one_hot.astype(np.float32)
+        n_s_qaqa += np.rint(one_hot.T @ one_hot).astype(np.int64)
+    return n_s_qaqa.reshape(N_q, N_a, N_q, N_a)
+
+def file_hash(filename):
+    """h = file_hash(filename)
+
+    The SHA-1 hex digest of the contents of the file, read in blocks.
+    """
+    return prefix_hash(filename, os.path.getsize(filename))
+
+def read_cooccurrence(cache_dir, scantron_filename, a, N_a, variant="", scantron_hash=None):
+    """n_s_qaqa = read_cooccurrence(cache_dir, scantron_filename, a, N_a, variant="", scantron_hash=None)
+
+    Read the co-occurrence counts from the cache directory if they were
+    counted from the same Scantron file (and the same variant of
+    reading it, such as with duplicates dropped), otherwise compute
+    them with count_cooccurrence() and save them in the cache. If
+    cache_dir is None then they are always computed. The scantron_hash
+    is the file_hash() of the Scantron file, if it is already known.
+    """
+    if cache_dir is None:
+        log_and_print("Computing co-occurrence counts")
+        return count_cooccurrence(a, N_a)
+    if scantron_hash is None:
+        scantron_hash = file_hash(scantron_filename)
+    filename = cache_filename(cache_dir, "cooccurrence.npz", "%d %d %s" % (a.shape[1], N_a, variant), scantron_hash)
+    def read_func(in_f):
+        with np.load(in_f) as cached:
+            return cached["n_s_qaqa"]
+    n_s_qaqa = read_cache(filename, read_func)
+    if n_s_qaqa is not None:
+        log_and_print("Read co-occurrence counts from cache: %s" % scantron_filename)
+        return n_s_qaqa
+    log_and_print("Computing co-occurrence counts")
+    n_s_qaqa = count_cooccurrence(a, N_a)
+    write_cache(filename, lambda out_f: np.savez(out_f, n_s_qaqa=n_s_qaqa))
+    return n_s_qaqa
+
+def generate_filtered_statistics(output_prefix, n_s_qaqa, filter_q, filter_a):
+    """d = generate_filtered_statistics(output_prefix, n_s_qaqa, filter_q, filter_a)
+
+    Look up the statistics for only the students who gave answer
+    'filter_a' to question number 'filter_q' in the co-occurrence
+    counts, and output them like generate_statistics().
+    """
+    (N_q, N_a) = n_s_qaqa.shape[:2]
+    qi = filter_q - 1
+    if qi < 0 or qi >= N_q:
+        raise Exception("filter_q = %d out of range (must be between 1 and %d)" % (filter_q, N_q))
+    N_s = n_s_qaqa[qi, filter_a, qi, filter_a]
+    if N_s == 0:
+        raise Exception("after filtering no scantrons were left")
+    log_and_print("Generating statistics for question %d answer %s" % (filter_q, ind2chr(filter_a)))
+    d = compute_statistics(n_s_qaqa[qi, filter_a], N_s)
+    write_statistics_csvs(output_prefix, d)
     log("Successfully completed generating statistics")
     return d
 
+def write_all_filtered_statistics(output_prefix, library, n_s_qaqa, figures_dir=None):
+    """reports = write_all_filtered_statistics(output_prefix, library, n_s_qaqa, figures_dir=None)
+
+    Write the statistics files and report for every answer to every
+    question that at least one student gave, with filenames starting
+    with the filtered_prefix(). Returns the list of (report filename,
+    figure names) for compile_reports().
+    """
+    reports = []
+    (N_q, N_a) = n_s_qaqa.shape[:2]
+    for qi in range(N_q):
+        for ai in range(N_a):
+            if n_s_qaqa[qi, ai, qi, ai] == 0:
+                continue
+            prefix = filtered_prefix(output_prefix, qi + 1, ai)
+            d = generate_filtered_statistics(prefix + "stats", n_s_qaqa, qi + 1, ai)
+            figure_names = write_statistics(prefix + "report.tex", library, d, figures_dir)
+            reports.append((prefix + "report.tex", figure_names))
+    return reports
+
+def filtered_prefix(prefix, filter_q, filter_a):
+    """filter_prefix = filtered_prefix(prefix, filter_q, filter_a)
+
+    The filename prefix for output filtered by question number
+    'filter_q' and answer index 'filter_a', like "example_q3B_".
+    """
+    return prefix + "q%d%s_" % (filter_q, ind2chr(filter_a))
+
+######################################################################
+######################################################################
+
+def count_answers_by_group(a, group, n_groups, N_a, chunk_size=65536):
+    """n_g_qa = count_answers_by_group(a, group, n_groups, N_a, chunk_size=65536)
+
+    Count the answers of each group of students in a single bincount
+    pass over the answer matrix, as for count_answers(), taken over
+    chunks of chunk_size students at a time (so a can be memory
+    mapped).
+
+    n_g_qa[g,q,a] = number of students s with group[s] = g giving
+                    answer a to question q
+    """
+    (N_s, N_q) = a.shape
+    n_g_qa = np.zeros(n_groups * N_q * N_a, dtype=np.int64)
+    for i in range(0, N_s, chunk_size):
+        a_block = np.asarray(a[i:i + chunk_size])
+        valid = (a_block >= 0) & (a_block < N_a)
+        index = (group[i:i + chunk_size, None] * N_q + np.arange(N_q)) * N_a + a_block.astype(np.intp)
+        n_g_qa += np.bincount(index[valid], minlength=n_groups * N_q * N_a)
+    return n_g_qa.reshape(n_groups, N_q, N_a)
+
+def generate_section_statistics(output_prefix, a, section, N_a):
+    """(sections, ds) = generate_section_statistics(output_prefix, a, section, N_a)
+
+    Compute the statistics for the students in each section with one
+    grouped count over the answer matrix, and output them like
+    generate_statistics() with filenames starting with the
+    section_prefix().
+
+    sections[g] = Section field of group g, in sorted order
+    ds[g] = statistics structure for the students in section sections[g]
+    """
+    log_and_print("Generating statistics for each section")
+    (sections, group) = np.unique(section, return_inverse=True)
+    group = group.ravel()
+    n_g_qa = count_answers_by_group(a, group, len(sections), N_a)
+    N_g = np.bincount(group, minlength=len(sections))
+    log_array(N_g, "N_g", ["N_sections"])
+    ds = []
+    for (gi, name) in enumerate(sections):
+        d = compute_statistics(n_g_qa[gi], int(N_g[gi]))
+        write_statistics_csvs(section_prefix(output_prefix, name) + "stats", d)
+        ds.append(d)
+    log("Successfully completed generating statistics for each section")
+    return (sections, ds)
+
+def write_section_statistics(output_prefix, library, a, section, figures_dir=None):
+    """reports = write_section_statistics(output_prefix, library, a, section, figures_dir=None)
+
+    Write the statistics files for every section with
+    generate_section_statistics(), and a <prefix>sections_report.tex
+    report with one chapter per section. Returns the list of (report
+    filename, figure names) for compile_reports().
+    """
+    (sections, ds) = generate_section_statistics(output_prefix, a, section, N_a)
+    report_filename = output_prefix + "sections_report.tex"
+    chapters = [("Section %s (%d students)" % (name, d.N_s), d) for (name, d) in zip(sections, ds)]
+    figure_names = write_report(report_filename, library, chapters, figures_dir, documentclass="report")
+    return [(report_filename, figure_names)]
+
+def section_prefix(prefix, section):
+    """section_prefix = section_prefix(prefix, section)
+
+    The filename prefix for output for only the students in the given
+    section, like "example_section008_".
+    """
+    return prefix + "section%s_" % section
+
+######################################################################
+######################################################################
+
+def compute_correlations(n_s_qaqa):
+    """(pearson_qq, spearman_qq) = compute_correlations(n_s_qaqa)
+
+    Compute the correlation between the answers (1 = A, 5 = E) to
+    every pair of questions from the co-occurrence counts, using only
+    the students who answered both questions (pairwise-complete), so
+    blank answers are left out of each pair separately.
+
+    pearson_qq[q1,q2] = Pearson correlation between questions q1 and q2
+    spearman_qq[q1,q2] = Spearman rank correlation between q1 and q2
+
+    The answer counts of each question among the students who answered
+    the other question are sums of n_s_qaqa, so all the pairwise sums
+    are whole-array operations. The Spearman ranks are the average
+    ranks of each answer among those students, as if each pair were
+    ranked on its own. Pairs with fewer than two students or with all
+    the same answers have a correlation of NaN.
+    """
+    (N_q, N_a) = n_s_qaqa.shape[:2]
+    n = n_s_qaqa.astype(np.float64)
+    # n_qaq[q1,a1,q2] = number of students giving answer a1 to q1 who answered q2
+    n_qaq = n.sum(axis=3)
+    n_qq = n_qaq.sum(axis=1)
+    values = np.broadcast_to((np.arange(N_a) + 1.0)[None, :, None], n_qaq.shape)
+    # average rank of each answer, centred on the mean rank (n_qq + 1) / 2
+    ranks = np.cumsum(n_qaq, axis=1) - (n_qaq - 1) / 2 - (n_qq[:, None, :] + 1) / 2
+    pearson_qq = pairwise_correlation(n, n_qaq, n_qq, values)
+    spearman_qq = pairwise_correlation(n, n_qaq, n_qq, ranks)
+    return (pearson_qq, spearman_qq)
+
+def pairwise_correlation(n, n_qaq, n_qq, x):
+    """r_qq = pairwise_correlation(n, n_qaq, n_qq, x)
+
+    The Pearson correlation between every pair of questions, where
+    x[q1,a1,q2] is the value given to answer a1 to question q1 among
+    the students who answered q2, and n, n_qaq and n_qq are the counts
+    from compute_correlations().
+    """
+    s_x = np.einsum("iak,iak->ik", x, n_qaq)
+    s_xx = np.einsum("iak,iak->ik", x * x, n_qaq)
+    s_xy = np.einsum("iak,iakb,kbi->ik", x, n, x, optimize=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cov = s_xy - s_x * s_x.T / n_qq
+        var = s_xx - s_x * s_x / n_qq
+        r_qq = cov / np.sqrt(var * var.T)
+    # the correlation is undefined where a variance is zero (up to rounding)
+    r_qq[(n_qq < 2) | ~(var > 1e-9 * n_qq) | ~(var.T > 1e-9 * n_qq)] = np.nan
+    return np.clip(r_qq, -1, 1)
+
+def generate_correlations(output_prefix, d, a, n_s_qaqa=None):
+    """generate_correlations(output_prefix, d, a, n_s_qaqa=None)
+
+    Add the pearson_qq and spearman_qq correlation matrices from
+    compute_correlations() to d and write them to CSV files with the
+    given output_prefix. The co-occurrence counts n_s_qaqa of the
+    answer matrix a are counted with count_cooccurrence() if they are
+    not given (a can be memory mapped).
+    """
+    log_and_print("Generating correlations between questions")
+    if n_s_qaqa is None:
+        n_s_qaqa = count_cooccurrence(a, d.N_a)
+    (d.pearson_qq, d.spearman_qq) = compute_correlations(n_s_qaqa)
+    log_array(d.spearman_qq, "spearman_qq", ["N_q", "N_q"])
+    write_csv(output_prefix + "_pearson_qq.csv", ["q", "pearson(q,q2=%s)"], d.pearson_qq)
+    write_csv(output_prefix + "_spearman_qq.csv", ["q", "spearman(q,q2=%s)"], d.spearman_qq)
+    log("Successfully completed generating correlations")
+
 ######################################################################
 ######################################################################
 
@@ -568,7 +3383,14 @@ def write_stats_tex_question_answers_left_right(out_f, library, d):
 
         out_f.write(r"\end{longtable}" + "\n")
 
-def write_stats_tex_question_answers(out_f, library, d):
+def write_stats_tex_question_answers(out_f, library, d, preamble="", figures_dir=None):
+    """figure_names = write_stats_tex_question_answers(out_f, library, d, preamble="", figures_dir=None)
+
+    If figures_dir is given then each figure is named by figure_name()
+    so that it can be externalized by compile_reports(), and the list
+    of names is returned.
+    """
+    figure_names = []
     qi = 0
     width = 5
     for zone in library.zones:
@@ -582,59 +3404,15 @@ def write_stats_tex_question_answers(out_f, library, d):
             out_f.write(r"& \parbox[b]{\hsize}{\raggedleft \scriptsize %s}" % question.left_choice + "\n")
             out_f.write(r"&" + "\n")
             out_f.write(r"\hspace*{-1.3em}" + "\n")
-            if PLOT_STYLE == "bar":
-                out_f.write(r"\begin{tikzpicture}[baseline]" + "\n")
-                out_f.write(r"\begin{axis}[" + "\n")
-                out_f.write(r"title={\scriptsize N = %d}," % d.n_s_q[qi] + "\n")
-                out_f.write(r"every axis title shift=0pt," + "\n")
-                out_f.write(r"ybar, ymin=0," + "\n")
-                out_f.write(r"width=%gcm, height=2.5cm," % width + "\n")
-                #out_f.write(r"symbolic x coords={A,B,C,D,E,none}," + "\n")
-                out_f.write(r"symbolic x coords={A,B,C,D,E}," + "\n")
-                out_f.write(r"xtick=data," + "\n")
-                out_f.write(r"enlarge x limits=0.12," + "\n")
-                out_f.write(r"xticklabel style={font=\scriptsize}," + "\n")
-                out_f.write(r"yticklabel style={font=\scriptsize}," + "\n")
-                out_f.write(r"xtick pos=left," + "\n")
-                #out_f.write(r"bar width=%gcm," % (width / float(d.N_a + 1) / 2) + "\n")
-                out_f.write(r"bar width=%gcm," % (width / float(d.N_a) / 2) + "\n")
-                out_f.write(r"]" + "\n")
-                out_f.write(r"\addplot coordinates {" + "\n")
-                for ai in range(d.N_a):
-                    #out_f.write(r"(%s,%g)" % (ind2chr(ai), d.r_s_qa[qi,ai] * 100) + "\n")
-                    value = d.r_s_qa[qi,ai] / d.r_s_qa[qi,:].sum() * 100
-                    label = ind2chr(ai)
-                    out_f.write(r"(%s,%g)" % (label, value) + "\n")
-                #out_f.write(r"(none,%g) [0]" % (d.r_na_q[qi] * 100) + "\n")
-                out_f.write(r"};" + "\n")
-                out_f.write(r"\end{axis}" + "\n")
-                out_f.write(r"\end{tikzpicture}" + "\n")
-            elif PLOT_STYLE == "stacked":
-                out_f.write(r"\begin{tikzpicture}[baseline]" + "\n")
-                out_f.write(r"\begin{axis}[" + "\n")
-                out_f.write(r"title={\scriptsize N = %d}," % d.n_s_q[qi] + "\n")
-                out_f.write(r"every axis title shift=0pt," + "\n")
-                out_f.write(r"width=%gcm,height=2.1cm," % width + "\n")
-                out_f.write(r"xbar stacked," + "\n")
-                out_f.write(r"ytick=\empty," + "\n")
-                out_f.write(r"xmin=0, xmax=100," + "\n")
-                out_f.write(r"xtick={0,25,50,75,100}," + "\n")
-                out_f.write(r"xticklabel style={font=\scriptsize}," + "\n")
-                out_f.write(r"nodes near coords," + "\n")
-                out_f.write(r"point meta=explicit symbolic," + "\n")
-                out_f.write(r"cycle list={{fill=blue!50!white,font={\tiny}},{fill=blue!20!white,font={\tiny}},{fill=black!10!white,font={\tiny}},{fill=red!20!white,font={\tiny}},{fill=red!50!white,font={\tiny}}}," + "\n")
-                out_f.write(r"]" + "\n")
-                for ai in range(d.N_a):
-                    # slightly shorten to fix bug where labels aren't rendered if total is slightly more than 100
-                    value = d.r_s_qa[qi,ai] / d.r_s_qa[qi,:].sum() * 100 * 0.999
-                    label = ind2chr(ai) if value > 7 else ""
-                    out_f.write(r"\addplot coordinates {" + "\n")
-                    out_f.write(r"(%g,1) [%s]" % (value, label) + "\n")
-                    out_f.write(r"};" + "\n")
-                out_f.write(r"\end{axis}" + "\n")
-                out_f.write(r"\end{tikzpicture}" + "\n")
+            figure = io.StringIO()
+            write_stats_tex_figure(figure, d, qi, width)
+            if figures_dir is None:
+                out_f.write(figure.getvalue())
             else:
-                raise Exception("unknown PLOT_STYLE: " + PLOT_STYLE)
+                name = figure_name(preamble, figure.getvalue())
+                figure_names.append(name)
+                out_f.write(r"\tikzsetnextfilename{%s}" % name + "\n")
+                out_f.write(figure.getvalue())
             out_f.write(r"\hspace*{-1em}" + "\n")
             out_f.write(r"& \parbox[b]{\hsize}{\raggedright \scriptsize %s} \\[1.1em]" % question.right_choice + "\n")
             out_f.write(r"\hline\\[0.2em]" + "\n")
@@ -642,31 +3420,496 @@ def write_stats_tex_question_answers(out_f, library, d):
             qi += 1
 
         out_f.write(r"\end{longtable}" + "\n")
+    return figure_names
+
+def write_stats_tex_correlations(out_f, library, d, preamble="", figures_dir=None):
+    """figure_names = write_stats_tex_correlations(out_f, library, d, preamble="", figures_dir=None)
+
+    Write the heatmap of the Spearman correlations between questions,
+    with the figure externalized as for
+    write_stats_tex_question_answers().
+    """
+    out_f.write(r"\vspace{2em}" + "\n")
+    out_f.write(r"\subsection*{Correlations between questions}" + "\n")
+    out_f.write(r"Spearman rank correlation between the answers to each pair of questions,"
+                r" from the students who answered both questions."
+                r" Red is a positive correlation and blue is negative, and the lines separate the zones." + "\n")
+    out_f.write("\n")
+    out_f.write(r"\begin{center}" + "\n")
+    figure = io.StringIO()
+    write_tikz_figure(figure, heatmap_geometry(library, d.spearman_qq, 12))
+    figure_names = []
+    if figures_dir is not None:
+        name = figure_name(preamble, figure.getvalue())
+        figure_names.append(name)
+        out_f.write(r"\tikzsetnextfilename{%s}" % name + "\n")
+    out_f.write(figure.getvalue())
+    out_f.write(r"\end{center}" + "\n")
+    return figure_names
+
+def write_stats_tex_figure(out_f, d, qi, width):
+    """write_stats_tex_figure(out_f, d, qi, width)
+
+    Write the tikzpicture of the answers to question index qi in the
+    PLOT_STYLE, with the PLOT_BACKEND.
+    """
+    if PLOT_BACKEND == "tikz":
+        write_tikz_figure(out_f, figure_geometry(d, qi, width))
+    elif PLOT_BACKEND != "pgfplots":
+        raise Exception("unknown PLOT_BACKEND: " + PLOT_BACKEND)
+    elif PLOT_STYLE == "bar":
+        out_f.write(r"\begin{tikzpicture}[baseline]" + "\n")
+        out_f.write(r"\begin{axis}[" + "\n")
+        out_f.write(r"title={\scriptsize %s}," % figure_title(d, qi) + "\n")
+        out_f.write(r"every axis title shift=0pt," + "\n")
+        out_f.write(r"ybar, ymin=0," + "\n")
+        out_f.write(r"width=%gcm, height=2.5cm," % width + "\n")
+        #out_f.write(r"symbolic x coords={A,B,C,D,E,none}," + "\n")
+        out_f.write(r"symbolic x coords={A,B,C,D,E}," + "\n")
+        out_f.write(r"xtick=data," + "\n")
+        out_f.write(r"enlarge x limits=0.12," + "\n")
+        out_f.write(r"xticklabel style={font=\scriptsize}," + "\n")
+        out_f.write(r"yticklabel style={font=\scriptsize}," + "\n")
+        out_f.write(r"xtick pos=left," + "\n")
+        #out_f.write(r"bar width=%gcm," % (width / float(d.N_a + 1) / 2) + "\n")
+        out_f.write(r"bar width=%gcm," % (width / float(d.N_a) / 2) + "\n")
+        out_f.write(r"]" + "\n")
+        if hasattr(d, "r_s_qa_lo"):
+            out_f.write(r"\addplot+[error bars/.cd, y dir=both, y explicit] coordinates {" + "\n")
+        else:
+            out_f.write(r"\addplot coordinates {" + "\n")
+        for ai in range(d.N_a):
+            #out_f.write(r"(%s,%g)" % (ind2chr(ai), d.r_s_qa[qi,ai] * 100) + "\n")
+            value = d.r_s_qa[qi,ai] / d.r_s_qa[qi,:].sum() * 100
+            label = ind2chr(ai)
+            if hasattr(d, "r_s_qa_lo"):
+                lo = d.r_s_qa_lo[qi,ai] / d.r_s_qa[qi,:].sum() * 100
+                hi = d.r_s_qa_hi[qi,ai] / d.r_s_qa[qi,:].sum() * 100
+                out_f.write(r"(%s,%g) += (0,%g) -= (0,%g)" % (label, value, hi - value, value - lo) + "\n")
+            else:
+                out_f.write(r"(%s,%g)" % (label, value) + "\n")
+        #out_f.write(r"(none,%g) [0]" % (d.r_na_q[qi] * 100) + "\n")
+        out_f.write(r"};" + "\n")
+        out_f.write(r"\end{axis}" + "\n")
+        out_f.write(r"\end{tikzpicture}" + "\n")
+    elif PLOT_STYLE == "stacked":
+        out_f.write(r"\begin{tikzpicture}[baseline]" + "\n")
+        out_f.write(r"\begin{axis}[" + "\n")
+        out_f.write(r"title={\scriptsize %s}," % figure_title(d, qi) + "\n")
+        out_f.write(r"every axis title shift=0pt," + "\n")
+        out_f.write(r"width=%gcm,height=2.1cm," % width + "\n")
+        out_f.write(r"xbar stacked," + "\n")
+        out_f.write(r"ytick=\empty," + "\n")
+        out_f.write(r"xmin=0, xmax=100," + "\n")
+        out_f.write(r"xtick={0,25,50,75,100}," + "\n")
+        out_f.write(r"xticklabel style={font=\scriptsize}," + "\n")
+        out_f.write(r"nodes near coords," + "\n")
+        out_f.write(r"point meta=explicit symbolic," + "\n")
+        out_f.write(r"cycle list={{fill=blue!50!white,font={\tiny}},{fill=blue!20!white,font={\tiny}},{fill=black!10!white,font={\tiny}},{fill=red!20!white,font={\tiny}},{fill=red!50!white,font={\tiny}}}," + "\n")
+        out_f.write(r"]" + "\n")
+        for ai in range(d.N_a):
+            # slightly shorten to fix bug where labels aren't rendered if total is slightly more than 100
+            value = d.r_s_qa[qi,ai] / d.r_s_qa[qi,:].sum() * 100 * 0.999
+            label = ind2chr(ai) if value > 7 else ""
+            out_f.write(r"\addplot coordinates {" + "\n")
+            out_f.write(r"(%g,1) [%s]" % (value, label) + "\n")
+            out_f.write(r"};" + "\n")
+        out_f.write(r"\end{axis}" + "\n")
+        out_f.write(r"\end{tikzpicture}" + "\n")
+    else:
+        raise Exception("unknown PLOT_STYLE: " + PLOT_STYLE)
+
+######################################################################
+######################################################################
+
+# RGB of the xcolor colors used in the plots
+COLORS = {
+    "white": (1.0, 1.0, 1.0),
+    "black": (0.0, 0.0, 0.0),
+    "blue": (0.0, 0.0, 1.0),
+    "red": (1.0, 0.0, 0.0),
+}
+
+# font sizes in pt for a 10pt document
+FONT_SIZES = {
+    "scriptsize": 7.0,
+    "tiny": 5.0,
+}
 
-def write_statistics(output_filename, library, d):
-    """write_statistics(output_filename, library, d)
+TICK_LENGTH = 0.15 # cm, as for pgfplots
 
-    Write summary statistics to the stats.tex file.
+def mix_color(color, percent, other="white"):
+    """rgb = mix_color(color, percent, other="white")
+
+    The color written "color!percent!other" in xcolor.
+    """
+    return tuple(percent / 100 * c + (1 - percent / 100) * o
+                 for (c, o) in zip(COLORS[color], COLORS[other]))
+
+def nice_ticks(vmax, max_ticks=5):
+    """ticks = nice_ticks(vmax, max_ticks=5)
+
+    Tick values from 0 to at most vmax, spaced by 1, 2 or 5 times a
+    power of 10, with no more than max_ticks ticks.
+    """
+    if vmax <= 0:
+        return [0.0]
+    power = 10 ** np.floor(np.log10(vmax))
+    for step in [power / 10 * m for m in [1, 2, 5]] + [power * m for m in [1, 2, 5, 10]]:
+        if vmax / step < max_ticks:
+            break
+    return [i * step for i in range(int(np.floor(vmax / step + 1e-9)) + 1)]
+
+def figure_title(d, qi):
+    """title = figure_title(d, qi)
+
+    The title of the plot of question index qi: the number of
+    responses, and the average response with its bootstrap interval if
+    there is one.
+    """
+    if hasattr(d, "p_q_lo"):
+        return "N = %d, mean %.2f [%.2f, %.2f]" % (d.n_s_q[qi], d.p_q[qi], d.p_q_lo[qi], d.p_q_hi[qi])
+    return "N = %d" % d.n_s_q[qi]
+
+def figure_geometry(d, qi, width):
+    """shapes = figure_geometry(d, qi, width)
+
+    The plot of the answers to question index qi in the PLOT_STYLE, as
+    a list of shapes laid out in the same way as the pgfplots axis.
+    Coordinates are in cm, with the bottom left of the axis box at the
+    origin:
+
+    Struct(kind="rect", x0, y0, x1, y1, fill, stroke)
+    Struct(kind="line", x0, y0, x1, y1, stroke)
+    Struct(kind="text", x, y, text, font, anchor)
+
+    with fill and stroke RGB colors (or None) and anchor one of
+    "north", "south", "east" or "center".
+    """
+    shapes = []
+    def rect(x0, y0, x1, y1, fill=None, stroke=COLORS["black"]):
+        shapes.append(Struct(kind="rect", x0=x0, y0=y0, x1=x1, y1=y1, fill=fill, stroke=stroke))
+    def line(x0, y0, x1, y1):
+        shapes.append(Struct(kind="line", x0=x0, y0=y0, x1=x1, y1=y1, stroke=COLORS["black"]))
+    def text(x, y, s, font, anchor):
+        shapes.append(Struct(kind="text", x=x, y=y, text=s, font=font, anchor=anchor))
+    total = d.r_s_qa[qi,:].sum()
+    scale = 100 / total if total > 0 else 0.0
+    values = d.r_s_qa[qi,:] * scale
+    if PLOT_STYLE == "bar":
+        (axis_w, axis_h) = (width - 0.9, 2.5 - 0.9)
+        top = values.max()
+        if hasattr(d, "r_s_qa_hi"):
+            top = max(top, (d.r_s_qa_hi[qi,:] * scale).max())
+        ticks = nice_ticks(top)
+        ymax = max(top, ticks[-1]) * 1.1
+        # enlarge x limits=0.12
+        xpos = lambda ai: (ai + 0.12 * (d.N_a - 1)) / (1.24 * (d.N_a - 1)) * axis_w
+        bar_w = width / float(d.N_a) / 2
+        for ai in range(d.N_a):
+            x = xpos(ai)
+            rect(x - bar_w / 2, 0, x + bar_w / 2, values[ai] / ymax * axis_h,
+                 fill=mix_color("blue", 30), stroke=COLORS["blue"])
+            if hasattr(d, "r_s_qa_lo"):
+                (lo, hi) = (d.r_s_qa_lo[qi,ai] * scale / ymax * axis_h, d.r_s_qa_hi[qi,ai] * scale / ymax * axis_h)
+                line(x, lo, x, hi)
+                line(x - bar_w / 4, lo, x + bar_w / 4, lo)
+                line(x - bar_w / 4, hi, x + bar_w / 4, hi)
+            line(x, 0, x, TICK_LENGTH)
+            text(x, -0.1, ind2chr(ai), "scriptsize", "north")
+        for tick in ticks:
+            y = tick / ymax * axis_h
+            line(0, y, TICK_LENGTH, y)
+            line(axis_w - TICK_LENGTH, y, axis_w, y)
+            text(-0.1, y, "%g" % tick, "scriptsize", "east")
+    elif PLOT_STYLE == "stacked":
+        (axis_w, axis_h) = (width - 0.4, 2.1 - 0.9)
+        fills = [mix_color("blue", 50), mix_color("blue", 20), mix_color("black", 10),
+                 mix_color("red", 20), mix_color("red", 50)]
+        bar_h = 10 / 72.27 * 2.54 # bar width=10pt
+        (y0, y1) = (axis_h / 2 - bar_h / 2, axis_h / 2 + bar_h / 2)
+        x = 0.0
+        for ai in range(d.N_a):
+            x_next = x + values[ai] / 100 * axis_w
+            rect(x, y0, x_next, y1, fill=fills[ai % len(fills)])
+            if values[ai] > 7:
+                text((x + x_next) / 2, axis_h / 2, ind2chr(ai), "tiny", "center")
+            x = x_next
+        for tick in [0, 25, 50, 75, 100]:
+            x = tick / 100 * axis_w
+            line(x, 0, x, TICK_LENGTH)
+            line(x, axis_h - TICK_LENGTH, x, axis_h)
+            text(x, -0.1, "%g" % tick, "scriptsize", "north")
+    else:
+        raise Exception("unknown PLOT_STYLE: " + PLOT_STYLE)
+    rect(0, 0, axis_w, axis_h)
+    text(axis_w / 2, axis_h, figure_title(d, qi), "scriptsize", "south")
+    return shapes
+
+def heatmap_geometry(library, r_qq, size):
+    """shapes = heatmap_geometry(library, r_qq, size)
+
+    The heatmap of the correlation matrix r_qq as a list of shapes, as
+    for figure_geometry(), in a square of the given size with question
+    1 at the top left. Positive correlations are red and negative ones
+    blue, undefined ones (NaN) are grey, and lines mark the boundaries
+    between zones.
+    """
+    shapes = []
+    def rect(x0, y0, x1, y1, fill=None, stroke=COLORS["black"]):
+        shapes.append(Struct(kind="rect", x0=x0, y0=y0, x1=x1, y1=y1, fill=fill, stroke=stroke))
+    def line(x0, y0, x1, y1):
+        shapes.append(Struct(kind="line", x0=x0, y0=y0, x1=x1, y1=y1, stroke=COLORS["black"]))
+    def text(x, y, s, font, anchor):
+        shapes.append(Struct(kind="text", x=x, y=y, text=s, font=font, anchor=anchor))
+    def fill(r):
+        if np.isnan(r):
+            return mix_color("black", 20)
+        return mix_color("red" if r > 0 else "blue", abs(r) * 100)
+    N_q = r_qq.shape[0]
+    cell = size / N_q
+    label_step = max(1, int(np.ceil(N_q / 30.0)))
+    for q1 in range(N_q):
+        y = size - (q1 + 1) * cell
+        for q2 in range(N_q):
+            rect(q2 * cell, y, (q2 + 1) * cell, y + cell, fill=fill(r_qq[q1,q2]), stroke=None)
+        if (q1 + 1) % label_step == 0:
+            text(-0.05, y + cell / 2, "%d" % (q1 + 1), "tiny", "east")
+            text((q1 + 0.5) * cell, -0.05, "%d" % (q1 + 1), "tiny", "north")
+    qi = 0
+    for zone in library.zones[:-1]:
+        qi += len(zone.questions)
+        line(qi * cell, 0, qi * cell, size)
+        line(0, size - qi * cell, size, size - qi * cell)
+    rect(0, 0, size, size)
+    # color scale from -1 to 1 to the right of the heatmap
+    (x0, x1) = (size + 0.4, size + 0.7)
+    steps = 20
+    for i in range(steps):
+        r = -1 + (i + 0.5) * 2 / steps
+        rect(x0, i * size / steps, x1, (i + 1) * size / steps, fill=fill(r), stroke=None)
+    rect(x0, 0, x1, size)
+    for r in [-1, 0, 1]:
+        text(x1 + 0.35, (r + 1) / 2 * size, "%g" % r, "scriptsize", "center")
+    return shapes
+
+def write_tikz_figure(out_f, shapes):
+    """write_tikz_figure(out_f, shapes)
+
+    Write the shapes from figure_geometry() as a tikzpicture of plain
+    TikZ paths and nodes, with the baseline at the bottom of the axis.
+    """
+    def color(rgb):
+        return "{rgb,1:red,%.3f;green,%.3f;blue,%.3f}" % rgb
+    out_f.write(r"\begin{tikzpicture}[baseline=0pt,x=1cm,y=1cm]" + "\n")
+    for shape in shapes:
+        if shape.kind == "rect":
+            options = []
+            if shape.fill is not None:
+                options.append("fill=" + color(shape.fill))
+            if shape.stroke is not None:
+                options.append("draw=" + color(shape.stroke))
+            out_f.write(r"\path[%s] (%.3f,%.3f) rectangle (%.3f,%.3f);"
+                        % (",".join(options), shape.x0, shape.y0, shape.x1, shape.y1) + "\n")
+        elif shape.kind == "line":
+            out_f.write(r"\draw[draw=%s] (%.3f,%.3f) -- (%.3f,%.3f);"
+                        % (color(shape.stroke), shape.x0, shape.y0, shape.x1, shape.y1) + "\n")
+        elif shape.kind == "text":
+            out_f.write(r"\node[anchor=%s,inner sep=1pt,font=\%s] at (%.3f,%.3f) {%s};"
+                        % (shape.anchor, shape.font, shape.x, shape.y, shape.text) + "\n")
+    out_f.write(r"\end{tikzpicture}" + "\n")
+
+def write_svg_figure(out_f, shapes):
+    """write_svg_figure(out_f, shapes)
+
+    Write the shapes from figure_geometry() as an SVG image, for
+    previews without running TeX.
+    """
+    pt = 2.54 / 72.27 # cm per pt
+    xs = [x for shape in shapes for x in ([shape.x] if shape.kind == "text" else [shape.x0, shape.x1])]
+    ys = [y for shape in shapes for y in ([shape.y] if shape.kind == "text" else [shape.y0, shape.y1])]
+    (left, right) = (min(xs) - 0.6, max(xs) + 0.2)
+    (bottom, top) = (min(ys) - 0.4, max(ys) + 0.4)
+    def color(rgb):
+        return "none" if rgb is None else "rgb(%d,%d,%d)" % tuple(round(c * 255) for c in rgb)
+    # SVG y goes down the page
+    Y = lambda y: top - y
+    out_f.write('<svg xmlns="http://www.w3.org/2000/svg" width="%.3fcm" height="%.3fcm" viewBox="%.3f 0 %.3f %.3f">\n'
+                % (right - left, top - bottom, left, right - left, top - bottom))
+    out_f.write('<g stroke-width="%.4f" font-family="serif">\n' % (0.4 * pt))
+    for shape in shapes:
+        if shape.kind == "rect":
+            out_f.write('<rect x="%.3f" y="%.3f" width="%.3f" height="%.3f" fill="%s" stroke="%s"/>\n'
+                        % (min(shape.x0, shape.x1), Y(max(shape.y0, shape.y1)), abs(shape.x1 - shape.x0),
+                           abs(shape.y1 - shape.y0), color(shape.fill), color(shape.stroke)))
+        elif shape.kind == "line":
+            out_f.write('<line x1="%.3f" y1="%.3f" x2="%.3f" y2="%.3f" stroke="%s"/>\n'
+                        % (shape.x0, Y(shape.y0), shape.x1, Y(shape.y1), color(shape.stroke)))
+        elif shape.kind == "text":
+            (text_anchor, baseline) = {"north": ("middle", "hanging"), "south": ("middle", "text-after-edge"),
+                                       "east": ("end", "middle"), "center": ("middle", "middle")}[shape.anchor]
+            out_f.write('<text x="%.3f" y="%.3f" font-size="%.4f" text-anchor="%s" dominant-baseline="%s">%s</text>\n'
+                        % (shape.x, Y(shape.y), FONT_SIZES[shape.font] * pt, text_anchor, baseline,
+                           html.escape(shape.text)))
+    out_f.write('</g>\n</svg>\n')
+
+def write_svg_figures(output_dir, library, d):
+    """write_svg_figures(output_dir, library, d)
+
+    Write the plot of each question as q1.svg, q2.svg, etc in the
+    output directory, and the heatmap of the correlations between
+    questions as correlations.svg if d has them.
+    """
+    log_and_print("Writing SVG figures: %s" % output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    for qi in range(d.N_q):
+        with open(os.path.join(output_dir, "q%d.svg" % (qi + 1)), "w") as out_f:
+            write_svg_figure(out_f, figure_geometry(d, qi, 5))
+    if hasattr(d, "spearman_qq"):
+        with open(os.path.join(output_dir, "correlations.svg"), "w") as out_f:
+            write_svg_figure(out_f, heatmap_geometry(library, d.spearman_qq, 12))
+    log("Successfully completed writing SVG figures")
+
+def figure_name(preamble, figure):
+    """name = figure_name(preamble, figure)
+
+    The externalized figure name, which is a hash of the figure source
+    (and so of the plotted data and the PLOT_STYLE) and the document
+    preamble. A figure is only compiled again if its name changes.
+    """
+    return hashlib.sha1((preamble + figure).encode("utf-8")).hexdigest()
+
+def write_statistics(output_filename, library, d, figures_dir=None):
+    """figure_names = write_statistics(output_filename, library, d, figures_dir=None)
+
+    Write summary statistics to the stats.tex file. If figures_dir is
+    given then the figures are externalized to that directory with the
+    TikZ external library, and the list of figure names is returned
+    for compile_reports().
+    """
+    return write_report(output_filename, library, [(None, d)], figures_dir)
+
+def write_report(output_filename, library, chapters, figures_dir=None, documentclass="article"):
+    """figure_names = write_report(output_filename, library, chapters, figures_dir=None, documentclass="article")
+
+    Write a report with the statistics d for each (title, d) in
+    chapters, as for write_statistics(). Each title that is not None
+    starts a new chapter (which needs documentclass "report").
     """
     log_and_print("Writing statistics tex file: %s" % output_filename)
+    preamble = (r"\documentclass{%s}" % documentclass + "\n"
+                + r"\usepackage[margin=2.5cm]{geometry}" + "\n"
+                + r"\usepackage{pgfplots}" + "\n"
+                + r"\pgfplotsset{compat=1.10}" + "\n"
+                + r"\usepackage{longtable}" + "\n")
     with open(output_filename, "w") as out_f:
-        out_f.write(r"\documentclass{article}" + "\n")
-        out_f.write(r"\usepackage[margin=2.5cm]{geometry}" + "\n")
-        out_f.write(r"\usepackage{pgfplots}" + "\n")
-        out_f.write(r"\pgfplotsset{compat=1.10}" + "\n")
-        out_f.write(r"\usepackage{longtable}" + "\n")
+        out_f.write(preamble)
+        if figures_dir is not None:
+            prefix = os.path.relpath(figures_dir, os.path.dirname(output_filename) or ".")
+            out_f.write(r"\usetikzlibrary{external}" + "\n")
+            out_f.write(r"\tikzexternalize[prefix=%s/,mode=graphics if exists]" % prefix.replace(os.sep, "/") + "\n")
         out_f.write(r"\begin{document}" + "\n")
         out_f.write("\n")
         out_f.write(r"%s" % library.title_block + "\n")
         out_f.write("\n")
 
-        #write_stats_tex_question_answers_left_right(out_f, library, d)
-        #out_f.write(r"\newpage" + "\n")
-        #out_f.write(r"\centerline{\Large \bf Detailed response breakdown}" + "\n")
-        write_stats_tex_question_answers(out_f, library, d)
+        figure_names = []
+        for (title, d) in chapters:
+            if title is not None:
+                out_f.write(r"\chapter*{%s}" % title + "\n")
+                out_f.write("\n")
+            #write_stats_tex_question_answers_left_right(out_f, library, d)
+            #out_f.write(r"\newpage" + "\n")
+            #out_f.write(r"\centerline{\Large \bf Detailed response breakdown}" + "\n")
+            figure_names += write_stats_tex_question_answers(out_f, library, d, preamble, figures_dir)
+            if hasattr(d, "spearman_qq"):
+                figure_names += write_stats_tex_correlations(out_f, library, d, preamble, figures_dir)
 
         out_f.write(r"\end{document}" + "\n")
+    count_bytes_written(output_filename)
     log("Successfully completed writing statistics tex file")
+    return figure_names
+
+def compile_reports(reports, figures_dir, jobs=None):
+    """compile_reports(reports, figures_dir, jobs=None)
+
+    Compile each (report_filename, figure_names) in reports to PDF with
+    PDFLATEX. The externalized figures that are not already in
+    figures_dir are compiled first, each in its own PDFLATEX run with
+    up to 'jobs' runs in parallel (default: number of CPUs). Then the
+    reports are compiled, including the figure PDFs.
+    """
+    # checked once here, as the workers only return whether they failed
+    if shutil.which(PDFLATEX) is None:
+        die("ERROR: %s not found, it is needed for --compile", PDFLATEX)
+    os.makedirs(figures_dir, exist_ok=True)
+    figure_reports = {}
+    for (report_filename, figure_names) in reports:
+        for name in figure_names:
+            if not os.path.isfile(os.path.join(figures_dir, name + ".pdf")):
+                figure_reports.setdefault(name, report_filename)
+    n_figures = len(set(name for (report_filename, figure_names) in reports for name in figure_names))
+    log_and_print("Compiling %d changed figures of %d in: %s" % (len(figure_reports), n_figures, figures_dir))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        failed = [name for (name, ok) in zip(figure_reports, executor.map(
+            lambda name: compile_figure(figure_reports[name], figures_dir, name), figure_reports)) if not ok]
+        for name in failed:
+            log_and_print("WARNING: failed to compile figure, it will be drawn in the report instead: %s"
+                          % os.path.join(figures_dir, name + ".log"), level=LOG_WARNING)
+        results = list(executor.map(compile_report, [report_filename for (report_filename, figure_names) in reports]))
+    for ((report_filename, figure_names), ok) in zip(reports, results):
+        if not ok:
+            die("ERROR: failed to compile report, see: %s", os.path.splitext(report_filename)[0] + ".log")
+    log("Successfully completed compiling reports")
+
+def run_pdflatex(args, cwd):
+    """ok = run_pdflatex(args, cwd)
+
+    Run PDFLATEX with the given arguments in the directory cwd. This
+    runs in the compile_reports() workers, so a failure is returned
+    rather than ending the program.
+    """
+    try:
+        result = subprocess.run([PDFLATEX, "-interaction=batchmode", "-halt-on-error"] + args, cwd=cwd,
+                                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError as e:
+        log("Failed to run %s: %s", PDFLATEX, e, level=LOG_WARNING)
+        return False
+    return result.returncode == 0
+
+def compile_figure(report_filename, figures_dir, name):
+    """ok = compile_figure(report_filename, figures_dir, name)
+
+    Compile the single externalized figure 'name' from the report,
+    in the same way as the TikZ external library does.
+    """
+    (report_dir, report_basename) = os.path.split(report_filename)
+    jobname = os.path.join(os.path.relpath(figures_dir, report_dir or "."), name).replace(os.sep, "/")
+    job = os.path.splitext(report_basename)[0]
+    log("Compiling figure: %s", jobname)
+    ok = run_pdflatex(["-jobname", jobname, r"\def\tikzexternalrealjob{%s}\input{%s}" % (job, job)],
+                      report_dir or ".")
+    if not ok and os.path.isfile(os.path.join(figures_dir, name + ".pdf")):
+        # don't keep a broken figure, it would never be compiled again
+        os.remove(os.path.join(figures_dir, name + ".pdf"))
+    return ok
+
+def compile_report(report_filename):
+    """ok = compile_report(report_filename)
+
+    Compile the report, running PDFLATEX again while it asks for a
+    rerun (for the longtable column widths), up to 3 times.
+    """
+    (report_dir, report_basename) = os.path.split(report_filename)
+    log_filename = os.path.splitext(report_filename)[0] + ".log"
+    log_and_print("Compiling report: %s" % report_filename)
+    for i in range(3):
+        if not run_pdflatex([report_basename], report_dir or "."):
+            return False
+        with open(log_filename, encoding="latin1") as log_f:
+            if "Rerun" not in log_f.read():
+                break
+    return True
 
 ######################################################################
 ######################################################################
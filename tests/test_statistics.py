@@ -0,0 +1,104 @@
+"""Check the whole-array statistics code in process_survey.py against
+slow reference implementations that loop over every student, question
+and answer, on random answer matrices.
+
+Run with:
+
+    python -m pytest tests
+"""
+
+import os, sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import process_survey as ps
+
+SIZES = [(1, 1), (7, 3), (200, 26), (1000, ps.LAST_SCANTRON_QUESTION_NUMBER)]
+
+def random_answers(N_s, N_q, seed=0):
+    """a = random_answers(N_s, N_q, seed=0)
+
+    Random answer matrix with some answers past N_a and blank answers,
+    and no responses at all to the first question.
+    """
+    rng = np.random.RandomState(seed)
+    a = rng.randint(ps.NO_ANSWER, 9, size=(N_s, N_q)).astype(np.int8)
+    a[:, 0] = ps.NO_ANSWER
+    return a
+
+def compute_statistics_loops(a, N_a):
+    """d = compute_statistics_loops(a, N_a)
+
+    Slow reference version of compute_statistics(count_answers(a, N_a),
+    N_s) that loops over every student, question and answer.
+    """
+    d = ps.Struct()
+    (d.N_s, d.N_q) = a.shape
+    d.N_a = N_a
+    d.n_s_qa = np.zeros((d.N_q, d.N_a), dtype=int)
+    for si in range(d.N_s):
+        for qi in range(d.N_q):
+            ai = a[si,qi]
+            if ai >= 0 and ai < d.N_a:
+                d.n_s_qa[qi,ai] += 1
+    d.n_s_q = d.n_s_qa.sum(axis=1)
+    d.n_na_q = d.N_s - d.n_s_q
+    d.p_q = np.zeros(d.N_q, dtype=float)
+    d.r_s_qa = np.zeros((d.N_q, d.N_a), dtype=float)
+    d.r_na_q = np.zeros(d.N_q, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for qi in range(d.N_q):
+            for ai in range(d.N_a):
+                d.p_q[qi] += (ai + 1) * float(d.n_s_qa[qi,ai]) / d.n_s_q[qi]
+                d.r_s_qa[qi,ai] = float(d.n_s_qa[qi,ai]) / d.N_s
+            d.r_na_q[qi] = float(d.n_na_q[qi]) / d.N_s
+    return d
+
+def compute_correlations_loops(a, N_a):
+    """(pearson_qq, spearman_qq) = compute_correlations_loops(a, N_a)
+
+    Slow reference version of compute_correlations(count_cooccurrence(a,
+    N_a)) that loops over every pair of questions.
+    """
+    N_q = a.shape[1]
+    pearson_qq = np.full((N_q, N_q), np.nan)
+    spearman_qq = np.full((N_q, N_q), np.nan)
+    def ranks(x):
+        return np.array([(x < v).sum() + ((x == v).sum() + 1) / 2 for v in x])
+    for q1 in range(N_q):
+        for q2 in range(N_q):
+            both = (a[:, q1] >= 0) & (a[:, q1] < N_a) & (a[:, q2] >= 0) & (a[:, q2] < N_a)
+            x = a[both, q1] + 1.0
+            y = a[both, q2] + 1.0
+            if len(x) < 2 or x.min() == x.max() or y.min() == y.max():
+                continue
+            pearson_qq[q1,q2] = np.corrcoef(x, y)[0,1]
+            spearman_qq[q1,q2] = np.corrcoef(ranks(x), ranks(y))[0,1]
+    return (pearson_qq, spearman_qq)
+
+@pytest.mark.parametrize("N_s, N_q", SIZES)
+def test_compute_statistics(N_s, N_q):
+    a = random_answers(N_s, N_q)
+    d = ps.compute_statistics(ps.count_answers(a, ps.N_a), N_s)
+    d_ref = compute_statistics_loops(a, ps.N_a)
+    for name in ["n_s_qa", "n_s_q", "n_na_q", "p_q", "r_s_qa", "r_na_q"]:
+        assert np.array_equal(getattr(d, name), getattr(d_ref, name), equal_nan=True), name
+
+# the reference correlations loop over every pair of questions, so only check the smaller sizes
+@pytest.mark.parametrize("N_s, N_q", [size for size in SIZES if size[1] <= 26])
+def test_compute_correlations(N_s, N_q):
+    a = random_answers(N_s, N_q)
+    for (r_qq, r_qq_ref) in zip(ps.compute_correlations(ps.count_cooccurrence(a, ps.N_a)),
+                                compute_correlations_loops(a, ps.N_a)):
+        assert np.allclose(r_qq, r_qq_ref, equal_nan=True)
+
+@pytest.mark.parametrize("N_s, N_q", SIZES)
+@pytest.mark.parametrize("chunk_size", [1, 100, 2**22])
+def test_bootstrap_counts(N_s, N_q, chunk_size):
+    # bootstrap replicates against resampling each one directly
+    a = random_answers(N_s, N_q)
+    n_boot = 5
+    index = np.random.default_rng(3).integers(0, N_s, size=(n_boot, N_s))
+    n_b_qa_ref = np.array([ps.count_answers(a[index[b]], ps.N_a) for b in range(n_boot)])
+    assert np.array_equal(ps.bootstrap_counts(a, ps.N_a, n_boot, 3, chunk_size), n_b_qa_ref)